@@ -0,0 +1,78 @@
+"""
+Compares the keyed diff engine with set arithmetic over NodeAddr wrappers it replaced
+
+usage: python -m benchmarks.diff
+"""
+import random
+import timeit
+from typing import Any, List
+
+from winkle.diff import service_changes
+from winkle.types import Changes, Node
+
+class NodeAddr:
+	"""
+	Wrapper for `Node` which makes it comparable only by address/port (previous implementation)
+	"""
+
+	def __init__(self, node: Node):
+		self.node = node
+
+	def __hash__(self):
+		return hash(self.node[0:2])
+
+	def __eq__(self, other: Any):
+		if not isinstance(other, self.__class__):
+			return False
+
+		return self.node[0:2] == other.node[0:2]
+
+	def __getattribute__(self, item):
+		if item == 'node':
+			return object.__getattribute__(self, item)
+
+		return self.node.__getattribute__(item)
+
+def set_changes(old_nodes: List[Node], new_nodes: List[Node]) -> Changes:
+	old_nodes = set(old_nodes)
+	new_nodes = set(new_nodes)
+
+	old_addrs = set(map(NodeAddr, old_nodes))
+	new_addrs = set(map(NodeAddr, new_nodes))
+
+	added = frozenset(x.node for x in new_addrs - old_addrs)
+	removed = frozenset(x.node for x in old_addrs - new_addrs)
+	updated = frozenset(new_nodes - old_nodes - added)
+
+	return Changes(added, removed, updated)
+
+def node(i: int, weight: int = 10) -> Node:
+	attrs = {'rack': 'rack-%d' % (i % 16), 'weight': str(weight)}
+	return Node.create('10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255), 8080, 'node%d' % i, attrs,
+		['production', 'v2'])
+
+def nodes(count: int):
+	"""
+	Generates two states of a service; 1% of nodes are added, removed and updated
+	"""
+	old = [node(i) for i in range(count)]
+	new = [node(i, 20) if i % 100 == 0 else node(i) for i in range(count // 100, count + count // 100)]
+	random.shuffle(new)
+
+	return old, new
+
+def main():
+	print('%8s %12s %12s %8s' % ('nodes', 'sets [ms]', 'keyed [ms]', 'speedup'))
+
+	for count in (1000, 2000, 5000, 10000):
+		old, new = nodes(count)
+		assert set_changes(old, new) == service_changes(old, new)
+
+		repeat = max(1, 20000 // count)
+		sets = min(timeit.repeat(lambda: set_changes(old, new), number=repeat, repeat=3)) / repeat
+		keyed = min(timeit.repeat(lambda: service_changes(old, new), number=repeat, repeat=3)) / repeat
+
+		print('%8d %12.3f %12.3f %7.1fx' % (count, sets * 1000, keyed * 1000, sets / keyed))
+
+if __name__ == '__main__':
+	main()
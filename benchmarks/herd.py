@@ -0,0 +1,96 @@
+"""
+Simulates a fleet of listeners against a fake Consul which loses its leader, and shows how the request rate spreads
+out with fixed retry delays and waits (previous behaviour) compared to jittered ones
+
+usage: python -m benchmarks.herd [instances]
+"""
+import heapq
+import random
+import statistics
+import sys
+from collections import Counter
+from typing import Callable, Dict, List, Tuple
+
+from winkle.consul_listener import ConsulListener
+
+WAIT = 300      # wait of blocking queries, in seconds
+OUTAGE = 15     # how long consul is unavailable after the leader election
+DURATION = 900  # simulated time, in seconds
+
+class Policy:
+	def __init__(self, name: str, wait: Callable[[], float], backoff: Callable[[int], float]):
+		self.name = name
+		self.wait = wait
+		self.backoff = backoff
+
+def listener_policy(name: str, config: Dict[str, float]) -> Policy:
+	"""
+	Uses delays computed by the listener itself
+	"""
+	listener = ConsulListener({'sources': {'consul': config}})
+
+	return Policy(name, lambda: float(listener._wait()[:-1]), listener._backoff)
+
+def simulate(policy: Policy, instances: int) -> Tuple[Counter, List[float]]:
+	"""
+	Runs the simulation; every instance watches a single index (data center mode) and the leader election drops
+	all blocking queries at time 0
+	:return: number of requests per second and times when instances recovered
+	"""
+	requests = Counter()
+	recovered = []  # type: List[float]
+
+	events = [(0.0, instance, 'failed', 0) for instance in range(instances)]  # type: List[Tuple[float, int, str, int]]
+	heapq.heapify(events)
+
+	def blocking_query(now: float, instance: int) -> None:
+		requests[int(now)] += 1
+		# consul adds up to wait/16 of its own jitter
+		wait = policy.wait()
+		heapq.heappush(events, (now + wait + random.uniform(0, wait / 16), instance, 'timeout', 0))
+
+	while events:
+		now, instance, event, attempt = heapq.heappop(events)
+		if now > DURATION:
+			break
+
+		if event == 'timeout':
+			blocking_query(now, instance)
+		elif event == 'failed':
+			heapq.heappush(events, (now + policy.backoff(attempt), instance, 'retry', attempt + 1))
+		elif event == 'retry':
+			requests[int(now)] += 1
+			if now < OUTAGE:
+				heapq.heappush(events, (now + 0.05, instance, 'failed', attempt))
+			else:
+				# full fetch succeeded, continue with blocking queries
+				recovered.append(now)
+				blocking_query(now, instance)
+
+	return requests, recovered
+
+def main():
+	instances = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+	random.seed(42)
+
+	policies = [
+		Policy('fixed', lambda: WAIT, lambda attempt: 60),
+		listener_policy('jittered', {'wait': WAIT, 'wait-jitter': 0.1, 'retry-min': 1, 'retry-max': 60})
+	]
+
+	print('%d instances, consul unavailable for %d seconds after leader election' % (instances, OUTAGE))
+	print('%10s %12s %12s %14s %14s %12s' % ('policy', 'peak [rq/s]', 'wave [rq/s]', 'recovery [s]', 'last [s]',
+	                                         'requests'))
+
+	for policy in policies:
+		requests, recovered = simulate(policy, instances)
+
+		# peak of the wave of blocking queries returning after the recovery
+		wave = max(count for second, count in requests.items() if second > max(recovered) + WAIT / 2)
+
+		print('%10s %12d %12d %14.1f %14.1f %12d' % (policy.name, max(requests.values()), wave,
+		                                             statistics.median(recovered), max(recovered),
+		                                             sum(requests.values())))
+
+if __name__ == '__main__':
+	main()
@@ -14,7 +14,7 @@ def go_version(v):
 setup(
 	name = 'winkle',
 	version = go_version(version),
-	install_requires = ['aiohttp ~= 3.0.1', 'yamlcfg ~= 0.5.3'],
+	install_requires = ['aiohttp ~= 3.0.1', 'cachetools ~= 2.0.1', 'yamlcfg ~= 0.5.3'],
 	entry_points = {
 		'console_scripts': [
 			'winkle = winkle.main:main'
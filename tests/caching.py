@@ -0,0 +1,75 @@
+import asyncio
+from unittest import TestCase
+
+from winkle.caching import async_index_cache
+
+class AsyncIndexCache(TestCase):
+	def setUp(self):
+		self.loop = asyncio.new_event_loop()
+		self.requests = []
+		self.responses = {}
+
+		@async_index_cache({})
+		async def service(name, index=None, wait=None):
+			self.requests.append((name, index))
+			await asyncio.sleep(0)
+			return self.responses[name, index], name
+
+		self.service = service
+
+	def tearDown(self):
+		self.loop.close()
+
+	def run_loop(self, coroutine):
+		return self.loop.run_until_complete(coroutine)
+
+	def test_index(self):
+		self.responses = {('a', None): '10', ('a', '5'): '10', ('a', '10'): '11'}
+
+		with self.subTest("cold cache"):
+			self.assertEqual(self.run_loop(self.service('a')), ('10', 'a'))
+			self.assertEqual(self.requests, [('a', None)])
+
+		with self.subTest("cached index is newer than requested"):
+			self.assertEqual(self.run_loop(self.service('a', '5', '5m')), ('10', 'a'))
+			self.assertEqual(self.requests, [('a', None)])
+
+		with self.subTest("blocking on the cached index"):
+			self.assertEqual(self.run_loop(self.service('a', '10', '5m')), ('11', 'a'))
+			self.assertEqual(self.requests, [('a', None), ('a', '10')])
+
+	def test_watched(self):
+		self.responses = {('a', None): '10', ('b', None): '20'}
+		self.run_loop(self.service('a'))
+		self.run_loop(self.service('b'))
+
+		async def watch_and_get():
+			blocking = asyncio.ensure_future(self.service('a', '10', '5m'))
+			await asyncio.sleep(0)
+
+			result = await asyncio.gather(self.service('a'), self.service('b'))
+			blocking.cancel()
+
+			return result
+
+		self.requests.clear()
+		self.assertEqual(self.run_loop(watch_and_get()), [('10', 'a'), ('20', 'b')])
+		self.assertEqual(self.requests, [('a', '10'), ('b', None)])
+
+	def test_single_flight(self):
+		self.responses = {('a', None): '10'}
+
+		async def concurrent():
+			return await asyncio.gather(*[self.service('a') for _ in range(5)])
+
+		result = self.run_loop(concurrent())
+		self.assertEqual(result, [('10', 'a')] * 5)
+		self.assertEqual(self.requests, [('a', None)])
+
+	def test_index_reset(self):
+		self.responses = {('a', None): '10', ('a', '10'): '3', ('a', '1'): '3'}
+		self.run_loop(self.service('a'))
+
+		self.assertEqual(self.run_loop(self.service('a', '10', '5m')), ('3', 'a'))
+		self.assertEqual(self.run_loop(self.service('a', '1')), ('3', 'a'))
+		self.assertEqual(self.requests, [('a', None), ('a', '10')])
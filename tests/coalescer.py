@@ -0,0 +1,66 @@
+import asyncio
+from unittest import TestCase
+
+from winkle.coalescer import Coalescer
+from winkle.types import Changes, Node, hashabledict
+
+def changes(added=(), removed=()):
+	return Changes(frozenset(added), frozenset(removed), frozenset())
+
+class CoalescerTest(TestCase):
+	def setUp(self):
+		self.loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(self.loop)
+		self.updates = []
+
+	def tearDown(self):
+		asyncio.set_event_loop(None)
+		self.loop.close()
+
+	def test_burst(self):
+		nodes = [Node('10.0.0.%d' % i, 1234, 'node%d' % i, hashabledict(), frozenset()) for i in range(50)]
+		coalescer = Coalescer(lambda *args: self.updates.append(args), lambda service: (0.05, 1))
+
+		async def burst():
+			for node in nodes:
+				coalescer.submit('consul', {'service-1': changes(added=[node])})
+				await asyncio.sleep(0.001)
+
+			coalescer.submit('consul', {'service-1': changes(removed=nodes[:10])})
+
+			await asyncio.sleep(0.1)
+
+		self.loop.run_until_complete(burst())
+		self.assertEqual(self.updates, [('consul', {'service-1': changes(added=nodes[10:])})])
+
+	def test_maximum_delay(self):
+		node = Node('10.0.0.1', 1234, 'node1', hashabledict(), frozenset())
+		coalescer = Coalescer(lambda *args: self.updates.append(args), lambda service: (0.05, 0.1))
+
+		async def churn():
+			# changes keep coming faster than the quiet period
+			for _ in range(10):
+				coalescer.submit('consul', {'service-1': changes(added=[node])})
+				await asyncio.sleep(0.03)
+
+			await asyncio.sleep(0.1)
+
+		self.loop.run_until_complete(churn())
+		self.assertGreater(len(self.updates), 1)
+		self.assertLess(len(self.updates), 5)
+
+	def test_no_maximum_delay(self):
+		nodes = [Node('10.0.0.%d' % i, 1234, 'node%d' % i, hashabledict(), frozenset()) for i in range(10)]
+		coalescer = Coalescer(lambda *args: self.updates.append(args), lambda service: (0.05, 0))
+
+		async def churn():
+			# changes keep coming within the quiet period for several quiet periods
+			for node in nodes:
+				coalescer.submit('consul', {'service-1': changes(added=[node])})
+				await asyncio.sleep(0.03)
+
+			self.assertEqual(self.updates, [])
+			await asyncio.sleep(0.1)
+
+		self.loop.run_until_complete(churn())
+		self.assertEqual(self.updates, [('consul', {'service-1': changes(added=nodes)})])
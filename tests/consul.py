@@ -1,3 +1,4 @@
+import asyncio
 from unittest import TestCase
 
 from winkle import consul
@@ -18,3 +19,227 @@ class Consul(TestCase):
 			dc, service = consul.Consul.data_center('data center/test service')
 			self.assertEqual(dc, 'data center')
 			self.assertEqual(service, 'test service')
+
+	def test_next_index(self):
+		with self.subTest('Index moved forward'):
+			self.assertEqual(consul.Consul.next_index('10', '12'), '12')
+
+		with self.subTest('Index went backwards'):
+			self.assertEqual(consul.Consul.next_index('10', '5'), '0')
+
+		with self.subTest('Index lower than one'):
+			self.assertEqual(consul.Consul.next_index(None, '0'), '1')
+
+	def test_payload(self):
+		payload = consul.Payload(b'[{"Node": {"Node": "node1"}}]')
+		self.assertEqual(payload.json(), [{'Node': {'Node': 'node1'}}])
+		self.assertEqual(payload.digest, consul.Payload(b'[{"Node": {"Node": "node1"}}]').digest)
+		self.assertNotEqual(payload.digest, consul.Payload(b'[]').digest)
+
+	def test_agent_cache(self):
+		with self.subTest('Cache headers'):
+			self.assertEqual(consul.Consul.cache_status({}), (None, None))
+			self.assertEqual(consul.Consul.cache_status({'X-Cache': 'HIT', 'Age': '12'}), (True, 12))
+			self.assertEqual(consul.Consul.cache_status({'X-Cache': 'MISS'}), (False, None))
+
+		async def create(**kwargs):
+			return consul.Consul(**kwargs)
+
+		loop = asyncio.new_event_loop()
+		try:
+			agent = loop.run_until_complete(create(agent_cache=True, max_age=30))
+			try:
+				with self.subTest('Cached request'):
+					params = {}
+					agent.consistency(params, consul.Consistency.Stale)
+					agent.cached(params)
+					self.assertEqual(params, {'Stale': 'true', 'cached': ''})
+					self.assertEqual(agent._headers, {'Accept-Encoding': 'gzip', 'Cache-Control': 'max-age=30'})
+
+				with self.subTest('Consistent request bypasses the cache'):
+					params = {}
+					agent.consistency(params, consul.Consistency.Consistent)
+					agent.cached(params)
+					self.assertEqual(params, {'Consistent': 'true'})
+			finally:
+				loop.run_until_complete(agent._session.close())
+		finally:
+			loop.close()
+
+	def test_filter(self):
+		requests = []
+
+		class Agent(consul.Consul):
+			def __init__(self):
+				self._consistency = consul.Consistency.Default
+				self._agent_cache = False
+
+			async def get(self, path, params=None):
+				requests.append((path, params))
+				return {'x-consul-index': '10'}, consul.Payload(b'[]')
+
+		health = consul.Health(Agent())
+		loop = asyncio.new_event_loop()
+		try:
+			loop.run_until_complete(health.service('dc1/service', passing=True, tags=('production', 'http'),
+				filter='Service.Meta.env == "prod"'))
+		finally:
+			loop.close()
+
+		self.assertEqual(requests, [('/v1/health/service/service', [
+			('dc', 'dc1'), ('passing', 'true'), ('filter', 'Service.Meta.env == "prod"'), ('tag', 'production'),
+			('tag', 'http')])])
+
+	def test_payload_projection(self):
+		payload = consul.Payload(b'[{"Node": {"Node": "node1"}, "Checks": []}, {"Node": {"Node": "node2"}}]')
+		digest = payload.digest
+
+		self.assertEqual(payload.project(lambda entry: entry['Node']['Node']), ['node1', 'node2'])
+		self.assertIsNone(payload._data)
+		self.assertEqual(payload.project(lambda entry: None), ['node1', 'node2'])
+		self.assertEqual(payload.digest, digest)
+
+	def test_failover(self):
+		requests = []
+
+		class Agent(consul.Consul):
+			async def _fetch(self, url, params):
+				requests.append((url, params))
+				if url.startswith('http://agent1:8500/'):
+					if hang:
+						await asyncio.sleep(3600)
+					raise consul.ConnectionError('Connection refused')
+
+				return {'x-consul-index': '12'}, consul.Payload(b'[]')
+
+		async def run(test):
+			agent = Agent('agent1', '8500', agents=[('agent2', '8500'), ('agent3', '8501')])
+			try:
+				return await test(agent)
+			finally:
+				await agent._session.close()
+				await agent._check_session.close()
+
+		async def refused(agent):
+			index, _ = await agent.health.service('service', '10', '300s')
+			return index, [a.url for a in agent.agents()]
+
+		async def failed_during_request(agent):
+			request = asyncio.ensure_future(agent.get('/v1/health/service/service', {'index': '10'}))
+			await asyncio.sleep(0.01)
+			agent._fail(agent.agents()[0], 'check failed')
+			return await asyncio.wait_for(request, 1)
+
+		loop = asyncio.new_event_loop()
+		try:
+			with self.subTest('Agent refuses connections'):
+				hang = False
+				index, agents = loop.run_until_complete(run(refused))
+
+				self.assertEqual(index, '12')
+				self.assertEqual(agents, ['http://agent2:8500', 'http://agent3:8501', 'http://agent1:8500'])
+				self.assertEqual([url for url, _ in requests], ['http://agent1:8500/v1/health/service/service',
+					'http://agent2:8500/v1/health/service/service'])
+				# blocking query continues from the same index
+				self.assertEqual(requests[0][1], requests[1][1])
+
+			with self.subTest('Agent fails during a blocking query'):
+				hang = True
+				requests.clear()
+				headers, _ = loop.run_until_complete(run(failed_during_request))
+
+				self.assertEqual(headers['x-consul-index'], '12')
+				self.assertEqual(requests, [('http://agent1:8500/v1/health/service/service', {'index': '10'}),
+					('http://agent2:8500/v1/health/service/service', {'index': '10'})])
+		finally:
+			loop.close()
+
+	def test_error_response(self):
+		requests = []
+
+		class Agent(consul.Consul):
+			async def _fetch(self, url, params):
+				if params.get('dc') == 'dc2':
+					raise consul.HTTPResponseError(500, 'Internal Server Error', 'No path to datacenter')
+
+				requests.append(url)
+				await asyncio.sleep(0.05)
+				return {'x-consul-index': '12'}, consul.Payload(b'[]')
+
+		async def run(agents):
+			agent = Agent('agent1', '8500', agents=agents)
+			try:
+				blocking = asyncio.ensure_future(agent.get('/v1/health/service/service', {'index': '10'}))
+				await asyncio.sleep(0.01)
+
+				with self.assertRaises(consul.HTTPResponseError):
+					await agent.get('/v1/health/service/service', {'dc': 'dc2'})
+
+				headers, _ = await blocking
+				return headers['x-consul-index'], [a.failed for a in agent.agents()]
+			finally:
+				await agent._session.close()
+				await agent._check_session.close()
+
+		loop = asyncio.new_event_loop()
+		try:
+			for agents in ([], [('agent2', '8500')]):
+				with self.subTest('Error response doesn\'t abort other queries', agents=len(agents) + 1):
+					requests.clear()
+					index, failed = loop.run_until_complete(run(agents))
+					self.assertEqual(index, '12')
+					# the blocking query wasn't aborted and repeated
+					self.assertEqual(requests, ['http://agent1:8500/v1/health/service/service'])
+					self.assertTrue(all(value is None for value in failed))
+		finally:
+			loop.close()
+
+	def test_request_timeout(self):
+		timeout = consul.Consul.request_timeout
+
+		with self.subTest('Blocking queries outlast their wait and jitter'):
+			for wait in (300, 320, 600):
+				self.assertGreater(timeout({'index': '10', 'wait': '%ds' % wait}), wait * 17 / 16)
+
+		with self.subTest('Units of the wait'):
+			self.assertEqual(timeout([('wait', '5m')]), timeout([('wait', '300s')]))
+			self.assertEqual(timeout([('wait', '1h')]), timeout([('wait', '10m')]))
+
+		with self.subTest('Default wait of consul'):
+			self.assertEqual(timeout(None), timeout({'wait': '300s'}))
+
+		timeouts = []
+
+		class Response:
+			status = 200
+			headers = {'content-type': 'application/json', 'x-consul-index': '12'}
+
+			async def read(self):
+				return b'[]'
+
+		class Request:
+			async def __aenter__(self):
+				return Response()
+
+			async def __aexit__(self, *args):
+				pass
+
+		class Session:
+			def get(self, url, params=None, headers=None, timeout=None):
+				timeouts.append(timeout)
+				return Request()
+
+		async def query():
+			agent = consul.Consul()
+			await agent._session.close()
+			await agent._check_session.close()
+			agent._session = Session()
+			return await agent.health.service('service', '10', '320s')
+
+		loop = asyncio.new_event_loop()
+		try:
+			self.assertEqual(loop.run_until_complete(query())[0], '12')
+		finally:
+			loop.close()
+
+		self.assertGreater(timeouts[0], 320 * 17 / 16)
@@ -1,9 +1,254 @@
-from unittest import TestCase
+import asyncio
+import tempfile
+from pathlib import Path
+from unittest import TestCase, mock
 
-from winkle import consul_listener
+from winkle import consul, consul_listener
+from winkle.types import Changes, Node, hashabledict
+
+def listener(state_file=None):
+	result = consul_listener.ConsulListener({'sources': {'consul': {'monitor': 'service', 'state-file': state_file,
+	                                                                 'state-interval': 0}}})
+	result.set_hooks({
+		'source2service': lambda source, service: 'canonical-%s' % service
+	})
+	result._local.state = {}
+	result._local.digests = {}
+	result._local.indexes = {}
+	result._local.fetch_limit = None
+	result._local.save = None
+	result._local.save_pending = False
+
+	return result
 
 class ConsulListener(TestCase):
 	def test_get_monitor_services(self):
 		monitors = consul_listener.ConsulListener._get_monitor_services(['service1', 'service2', 'dc1/service3',
 		                                                                 'dc2/service4', 'dc1/service5'])
 		self.assertEqual(monitors, ['service1', 'dc1/service3', 'dc2/service4'])
+
+	def test_apply_state(self):
+		node1 = Node('1.1.1.1', 1234, 'node1', hashabledict(), frozenset())
+		node2 = Node('2.2.2.2', 1234, 'node2', hashabledict(), frozenset())
+		node3 = Node('3.3.3.3', 1234, 'node3', hashabledict(), frozenset())
+
+		source = listener()
+		source._local.state = {'service1': [node1, node2], 'service2': [node3]}
+
+		changes = source._apply_state({'service1': (b'digest1', [node2, node3]), 'service2': (b'digest2', None)})
+		self.assertEqual(changes, {'canonical-service1': Changes(frozenset([node3]), frozenset([node1]), frozenset())})
+		self.assertEqual(source._local.state, {'service1': (node2, node3), 'service2': [node3]})
+		self.assertEqual(source._local.digests, {'service1': b'digest1'})
+		self.assertEqual(source.stats['suppressed-updates'], 1)
+
+	def test_monitor_services(self):
+		node1 = Node('1.1.1.1', 1234, 'node1', hashabledict(), frozenset())
+		node2 = Node('2.2.2.2', 1234, 'node2', hashabledict(), frozenset())
+		requests, notifications = [], []
+
+		async def health_service(service, index=None):
+			requests.append((service, index))
+
+			if index is None:
+				return '10', service, b'digest10', [node1]
+
+			if service == 'service1' and index == '10':
+				return '11', service, b'digest11', [node1, node2]
+
+			if service == 'service2' and index == '10':
+				return '12', service, b'digest10', None
+
+			await asyncio.Future()  # block forever
+
+		source = listener()
+		source._health_service = health_service
+		source.change_detected = notifications.append
+
+		loop = asyncio.new_event_loop()
+		try:
+			with self.assertRaises(asyncio.TimeoutError):
+				loop.run_until_complete(asyncio.wait_for(source._monitor_services(['service1', 'service2']), 0.1))
+		finally:
+			loop.close()
+
+		self.assertEqual(notifications, [
+			{
+				'canonical-service1': Changes(frozenset([node1]), frozenset(), frozenset()),
+				'canonical-service2': Changes(frozenset([node1]), frozenset(), frozenset())
+			},
+			{
+				'canonical-service1': Changes(frozenset([node2]), frozenset(), frozenset())
+			}
+		])
+		self.assertCountEqual(requests, [('service1', None), ('service2', None), ('service1', '10'),
+		                                 ('service2', '10'), ('service1', '11'), ('service2', '12')])
+		self.assertEqual(source.stats['suppressed-updates'], 1)
+
+	def test_parse_tags(self):
+		source = listener()
+		parse_tags = consul_listener.ConsulListener._parse_tags
+
+		attrs, tags = parse_tags(('weight=20', 'production', 'rack=ab-c'))
+		self.assertEqual(attrs, hashabledict(weight='20', rack='ab-c'))
+		self.assertEqual(tags, frozenset(['production']))
+
+		hits = source.stats['tag-cache-hits']
+		self.assertIs(parse_tags(('weight=20', 'production', 'rack=ab-c'))[0], attrs)
+		self.assertEqual(source.stats['tag-cache-hits'], hits + 1)
+
+		with self.assertLogs(consul_listener.log, 'DEBUG') as logs:
+			source._local.state = {}
+			source._publish()
+		self.assertIn('tag-cache-hits: %d' % (hits + 1), logs.output[0])
+
+	def test_snapshot(self):
+		node1 = Node('1.1.1.1', 1234, 'node1', hashabledict(), frozenset())
+		node2 = Node('2.2.2.2', 1234, 'node2', hashabledict(), frozenset())
+
+		source = listener()
+		self.assertEqual(source.snapshot.version, 0)
+		self.assertEqual(source.service_nodes('service1'), ())
+
+		source._apply_state({'service1': (b'digest1', [node1])})
+		snapshot = source.snapshot
+		self.assertEqual(snapshot.version, 1)
+
+		source._apply_state({'service1': (b'digest2', [node1, node2])})
+		self.assertEqual(source.snapshot.version, 2)
+		self.assertEqual(source.service_nodes('service1'), (node1, node2))
+		self.assertEqual(source.service_nodes('service1', snapshot), (node1,))
+
+		source._apply_state({'service1': (b'digest2', None)})
+		self.assertEqual(source.snapshot.version, 2)
+
+	def test_warm_start(self):
+		node1 = Node.create('1.1.1.1', 1234, 'node1', {'weight': '10'}, ['production'])
+		node2 = Node.create('2.2.2.2', 1234, 'node2', {}, [])
+		requests, notifications = [], []
+
+		async def health_service(service, index=None):
+			requests.append((service, index))
+
+			if index is None:
+				return '5', service, b'digest5', [node2]
+
+			await asyncio.Future()  # block forever
+
+		with tempfile.TemporaryDirectory() as directory:
+			state_file = str(Path(directory) / 'consul.state')
+
+			async def apply(source, state):
+				changes = source._apply_state(state)
+				await source._local.save
+				return changes
+
+			loop = asyncio.new_event_loop()
+			try:
+				source = listener(state_file)
+				source._local.indexes = {'service1': '10'}
+				loop.run_until_complete(apply(source, {'service1': (b'digest1', [node1])}))
+
+				source = listener(state_file)
+				source._health_service = health_service
+				source.change_detected = notifications.append
+
+				state = source._load_state(['service1', 'service2'])
+				self.assertEqual(state, {'service1': (b'digest1', [node1])})
+				self.assertEqual(source._local.indexes, {'service1': '10'})
+
+				source.change_detected(loop.run_until_complete(apply(source, state)))
+
+				with self.assertRaises(asyncio.TimeoutError):
+					loop.run_until_complete(asyncio.wait_for(source._monitor_services(['service1', 'service2']), 0.1))
+			finally:
+				loop.close()
+
+		# only the service missing from the saved state is fetched from scratch
+		self.assertCountEqual(requests, [('service2', None), ('service1', '10'), ('service2', '5')])
+		self.assertEqual(notifications, [
+			{'canonical-service1': Changes(frozenset([node1]), frozenset(), frozenset())},
+			{'canonical-service2': Changes(frozenset([node2]), frozenset(), frozenset())}
+		])
+
+	def test_save_coalescing(self):
+		nodes = [Node.create('1.1.1.%d' % i, 1234, 'node%d' % i, {}, []) for i in range(5)]
+
+		with tempfile.TemporaryDirectory() as directory:
+			state_file = str(Path(directory) / 'consul.state')
+			source = listener(state_file)
+			source._config['state-interval'] = 0.05
+
+			async def changes():
+				for i in range(1, len(nodes) + 1):
+					source._apply_state({'service1': (b'digest%d' % i, nodes[:i])})
+					await asyncio.sleep(0.01)
+
+				await source._local.save
+
+			loop = asyncio.new_event_loop()
+			try:
+				with mock.patch.object(source, '_save_state', wraps=source._save_state) as save:
+					loop.run_until_complete(changes())
+			finally:
+				loop.close()
+
+			self.assertLess(save.call_count, len(nodes))
+			self.assertEqual(listener(state_file)._load_state(['service1']), {'service1': (b'digest5', nodes)})
+
+	def test_jitter(self):
+		source = consul_listener.ConsulListener({'sources': {'consul': {'wait': 300, 'wait-jitter': 0.2,
+		                                                                 'retry-min': 1, 'retry-max': 60}}})
+
+		waits = {source._wait() for _ in range(200)}
+		self.assertTrue(all(240 <= int(wait[:-1]) <= 300 for wait in waits))
+		self.assertGreater(len(waits), 10)
+
+		self.assertTrue(all(1 <= source._backoff(0) <= 2 for _ in range(10)))
+		self.assertTrue(all(1 <= source._backoff(3) <= 16 for _ in range(100)))
+		self.assertTrue(all(1 <= source._backoff(100) <= 60 for _ in range(100)))
+		self.assertGreater(max(source._backoff(100) for _ in range(100)), 8)
+
+	def test_fetch_limit(self):
+		active, peak = [0], [0]
+
+		class Health:
+			async def service(self, service, index, wait, **kwargs):
+				active[0] += 1
+				peak[0] = max(peak[0], active[0])
+				await asyncio.sleep(0.01)
+				active[0] -= 1
+				return '10', consul.Payload(b'[]')
+
+		source = listener()
+		source.set_hooks({'discovery_options': lambda source, service: {}})
+
+		async def fetch():
+			source._local.fetch_limit = asyncio.Semaphore(3)
+			source._local.consul = mock.Mock(health=Health())
+			return await asyncio.gather(*[source._health_service('service%d' % i) for i in range(10)])
+
+		loop = asyncio.new_event_loop()
+		try:
+			results = loop.run_until_complete(fetch())
+		finally:
+			loop.close()
+
+		self.assertEqual(len(results), 10)
+		self.assertEqual(peak[0], 3)
+
+	def test_connection_limit(self):
+		services = ['service1', 'service2', 'dc1/service3', 'dc2/service4']
+
+		with self.subTest('Service mode'):
+			self.assertEqual(listener()._connection_limit(services), 0)
+
+		with self.subTest('Data center mode'):
+			source = consul_listener.ConsulListener({'sources': {'consul': {'monitor': 'data-center'}}})
+			self.assertEqual(source._connection_limit(services), 13)
+
+	def test_parse_agent(self):
+		parse_agent = consul_listener.ConsulListener._parse_agent
+
+		self.assertEqual(parse_agent('consul1:8501'), ('consul1', '8501'))
+		self.assertEqual(parse_agent('consul1'), ('consul1', '8500'))
+		self.assertEqual(parse_agent('[::1]:8500'), ('[::1]', '8500'))
@@ -0,0 +1,74 @@
+from unittest import TestCase
+
+from winkle import diff
+from winkle.types import Changes, Node, hashabledict
+
+class Diff(TestCase):
+	def test_service_changes(self):
+		node1 = Node('1.1.1.1', 1234, 'node1', hashabledict(), frozenset())
+		node2 = Node('2.2.2.2', 1234, 'node2', hashabledict(), frozenset())
+		node2_weight = Node('2.2.2.2', 1234, 'node2', hashabledict(weight='20'), frozenset())
+		node3 = Node('3.3.3.3', 1234, 'node3', hashabledict(), frozenset())
+		node3_port = Node('3.3.3.3', 4321, 'node3', hashabledict(), frozenset())
+
+		with self.subTest("no changes"):
+			changes = diff.service_changes([node1, node2], [node2, node1])
+			self.assertEqual(changes, Changes(frozenset(), frozenset(), frozenset()))
+
+		with self.subTest("added and removed"):
+			changes = diff.service_changes([node1, node2], [node2, node3])
+			self.assertEqual(changes, Changes(frozenset([node3]), frozenset([node1]), frozenset()))
+
+		with self.subTest("updated"):
+			changes = diff.service_changes([node1, node2], [node1, node2_weight])
+			self.assertEqual(changes, Changes(frozenset(), frozenset(), frozenset([node2_weight])))
+
+		with self.subTest("port change is a different node"):
+			changes = diff.service_changes([node3], [node3_port])
+			self.assertEqual(changes, Changes(frozenset([node3_port]), frozenset([node3]), frozenset()))
+
+	def test_merge_changes(self):
+		node1 = Node('1.1.1.1', 1234, 'node1', hashabledict(), frozenset())
+		node1_weight = Node('1.1.1.1', 1234, 'node1', hashabledict(weight='20'), frozenset())
+		node2 = Node('2.2.2.2', 1234, 'node2', hashabledict(), frozenset())
+		empty = frozenset()
+
+		with self.subTest("added and removed cancel out"):
+			changes = diff.merge_changes(Changes(frozenset([node1]), empty, empty),
+				Changes(empty, frozenset([node1]), empty))
+			self.assertEqual(changes, Changes(empty, empty, empty))
+
+		with self.subTest("removed and added back cancel out"):
+			changes = diff.merge_changes(Changes(empty, frozenset([node1]), empty),
+				Changes(frozenset([node1]), empty, empty))
+			self.assertEqual(changes, Changes(empty, empty, empty))
+
+		with self.subTest("removed and added with different attributes is an update"):
+			changes = diff.merge_changes(Changes(empty, frozenset([node1]), empty),
+				Changes(frozenset([node1_weight]), empty, empty))
+			self.assertEqual(changes, Changes(empty, empty, frozenset([node1_weight])))
+
+		with self.subTest("added and updated stays added"):
+			changes = diff.merge_changes(Changes(frozenset([node1]), empty, empty),
+				Changes(empty, empty, frozenset([node1_weight])))
+			self.assertEqual(changes, Changes(frozenset([node1_weight]), empty, empty))
+
+		with self.subTest("updated and removed is removed"):
+			changes = diff.merge_changes(Changes(empty, empty, frozenset([node1_weight])),
+				Changes(frozenset([node2]), frozenset([node1_weight]), empty))
+			self.assertEqual(changes, Changes(frozenset([node2]), frozenset([node1_weight]), empty))
+
+	def test_merge_service_changes(self):
+		node1 = Node('1.1.1.1', 1234, 'node1', hashabledict(), frozenset())
+		empty = frozenset()
+
+		pending = {'service-1': Changes(frozenset([node1]), empty, empty)}
+		diff.merge_service_changes(pending, {
+			'service-1': Changes(empty, frozenset([node1]), empty),
+			'service-2': Changes(frozenset([node1]), empty, empty)
+		})
+
+		self.assertEqual(pending, {
+			'service-1': Changes(empty, empty, empty),
+			'service-2': Changes(frozenset([node1]), empty, empty)
+		})
@@ -1,13 +1,17 @@
+import asyncio
+import tempfile
 import unittest
 from pathlib import Path
 from unittest import mock
 
 from winkle.haproxy import HAProxy
-from winkle.types import Node
+from winkle.haproxy_comm import HAProxyComm
+from winkle.reload_budget import ReloadBudget
+from winkle.types import Changes, Node, Snapshot
 
 path = Path(__file__)
 
-def service_nodes(service, datacenter):
+def service_nodes(service, datacenter, snapshots=None):
 	return {
 		'service-1': [
 			Node('1.1.1.1', '1234', 'node1', {}, []),
@@ -160,3 +164,227 @@ class HAProxyTest(unittest.TestCase):
 	def test_services_needed(self):
 		got = self.haproxy.services_needed
 		self.assertDictEqual({'consul': ['consul-service-1'], 'marathon': ['marathon-service-1']}, got)
+
+	def test_slots(self):
+		self.haproxy._services['service-1'] = dict(self.haproxy._services['service-1'], slots=2)
+
+		with self.subTest("spare servers are rendered"):
+			got = self.haproxy._generate_config().decode()
+			self.assertIn('\tserver winkle-slot-1 0.0.0.0:1 disabled check inter 10000 rise 3 fall 2 weight 0\n'
+			              '\tserver winkle-slot-2 0.0.0.0:1 disabled check inter 10000 rise 3 fall 2 weight 0\n', got)
+
+		comm = self.haproxy._comm = mock.Mock()
+		comm.get_backends.return_value = ['service-1', 'service-2']
+		comm.get_all_servers_state.return_value = HAProxyComm._parse_servers_state([
+			'1',
+			'# be_id be_name srv_id srv_name srv_addr srv_op_state srv_admin_state srv_port',
+			'3 service-1 1 node1 1.1.1.1 2 0 1234',
+			'3 service-1 3 winkle-slot-1 5.5.5.5 2 0 1234',
+			'3 service-1 4 winkle-slot-2 0.0.0.0 0 1 1',
+		])
+		comm.is_server_disabled.return_value = False
+
+		# consul returns ports as integers, haproxy as strings
+		node2 = Node.create('2.2.2.2', 1234, 'node2', {}, [])
+		node5 = Node.create('5.5.5.5', 1234, 'node5', {}, [])
+		node6 = Node.create('6.6.6.6', 1234, 'node6', {}, [])
+		self.haproxy._node_weights = mock.Mock(return_value=[(node2, 10), (node6, 10)])
+
+		with self.subTest("nodes are assigned to free slots and released"):
+			changes = {'service-1': Changes(frozenset([node2]), frozenset([node5]), frozenset())}
+			self.assertFalse(self.haproxy._incremental_update(changes))
+			comm.assign_servers.assert_called_with([('service-1', 'winkle-slot-2', '2.2.2.2', 1234, 10)])
+			comm.release_servers.assert_called_with([('service-1', 'winkle-slot-1', '0.0.0.0', '1')])
+
+		with self.subTest("updated node in a slot doesn't need reload"):
+			node5 = Node.create('5.5.5.5', 1234, 'node5', {'weight': '50'}, [])
+			changes = {'service-1': Changes(frozenset(), frozenset(), frozenset([node5]))}
+			self.assertFalse(self.haproxy._incremental_update(changes))
+
+		with self.subTest("reload when slots run out"):
+			changes = {'service-1': Changes(frozenset([node2, node6]), frozenset(), frozenset())}
+			self.assertTrue(self.haproxy._incremental_update(changes))
+
+	def test_weights(self):
+		comm = self.haproxy._comm = mock.Mock()
+		comm.get_backends.return_value = ['service-1', 'service-2']
+		comm.get_all_servers_state.return_value = HAProxyComm._parse_servers_state([
+			'1',
+			'# be_id be_name srv_id srv_name srv_addr srv_op_state srv_admin_state srv_uweight srv_port',
+			'4 service-2 1 node3 3.3.3.3 2 0 20 4321',
+			'4 service-2 2 node4 4.4.4.4 2 0 10 4321',
+		])
+
+		with self.subTest("changed weight is set at runtime"):
+			node3 = Node.create('3.3.3.3', '4321', 'node3', {'rack': 'ab-c', 'weight': '50'}, [])
+			node4 = Node.create('4.4.4.4', '4321', 'node4', {'rack': 'de-f'}, [])
+			self.haproxy.set_hooks({'service_nodes': lambda *args: [node3, node4]})
+
+			changes = {'service-2': Changes(frozenset(), frozenset(), frozenset([node3]))}
+			self.assertFalse(self.haproxy._incremental_update(changes))
+			comm.set_weights.assert_called_with([('service-2', 'node3', 50)])
+
+		with self.subTest("renamed node needs reload"):
+			node3 = Node.create('3.3.3.3', '4321', 'node3-renamed', {'rack': 'ab-c'}, [])
+			self.haproxy.set_hooks({'service_nodes': lambda *args: [node3, node4]})
+
+			changes = {'service-2': Changes(frozenset(), frozenset(), frozenset([node3]))}
+			self.assertTrue(self.haproxy._incremental_update(changes))
+
+	def test_section_cache(self):
+		with path.with_name('haproxy.cfg').open() as f:
+			expected = f.read()
+
+		nodes = {'service-1': service_nodes('service-1', None), 'service-2': service_nodes('service-2', None)}
+		self.haproxy.set_hooks({'service_nodes': lambda service, *args: nodes[service]})
+
+		with mock.patch.object(self.haproxy, '_render_section', wraps=self.haproxy._render_section) as render:
+			self.assertEqual(expected, self.haproxy._generate_config().decode())
+			self.assertEqual(expected, self.haproxy._generate_config().decode())
+			self.assertEqual(render.call_count, 2)
+
+			nodes['service-2'] = nodes['service-2'][:1]
+			got = self.haproxy._generate_config().decode()
+			self.assertEqual(render.call_count, 3)
+			self.assertNotIn('node4', got)
+			self.assertEqual(got, expected.replace(
+				'\tserver node4 4.4.4.4:4321 id 518665542 check inter 10s rise 3 fall 2 weight 10\n', ''))
+
+	def test_section_cache_identity(self):
+		sources = {
+			'consul': {'consul-service-1': tuple(service_nodes('service-1', None))},
+			'marathon': {'marathon-service-1': tuple(service_nodes('service-2', None))}
+		}
+
+		def nodes(service, data_center, snapshots):
+			source, services = service2sources(service, data_center)
+			return [node for name in services for node in snapshots[source].services[name]]
+
+		collected = mock.Mock(side_effect=nodes)
+		self.haproxy.set_hooks({'service_nodes': collected, 'service2sources': service2sources})
+
+		snapshots = {source: Snapshot(1, services) for source, services in sources.items()}
+		expected = self.haproxy._generate_config(snapshots)
+
+		with mock.patch.object(self.haproxy, '_render_section', wraps=self.haproxy._render_section) as render:
+			with self.subTest("unchanged services are neither collected nor rendered"):
+				collected.reset_mock()
+				self.assertEqual(self.haproxy._generate_config(dict(snapshots)), expected)
+				collected.assert_not_called()
+				render.assert_not_called()
+
+			with self.subTest("only the updated service is collected"):
+				collected.reset_mock()
+				snapshots['marathon'] = Snapshot(2, {'marathon-service-1': sources['marathon']['marathon-service-1'][:1]})
+				self.assertNotIn('node4', self.haproxy._generate_config(snapshots).decode())
+				self.assertEqual([call[0][0] for call in collected.call_args_list], ['service-2'])
+				self.assertEqual([call[0][0] for call in render.call_args_list], ['service-2'])
+
+			with self.subTest("equal nodes in a new tuple aren't rendered again"):
+				render.reset_mock()
+				snapshots['consul'] = Snapshot(2, {'consul-service-1': tuple(service_nodes('service-1', None))})
+				self.haproxy._generate_config(snapshots)
+				render.assert_not_called()
+
+	def test_process_update(self):
+		async def run_blocking(task, *args):
+			return task(*args)
+
+		async def coroutine(result):
+			return result
+
+		self.haproxy.set_hooks({
+			'service_nodes': service_nodes,
+			'snapshot': dict,
+			'run_blocking': run_blocking
+		})
+		self.haproxy._services['service-2']['minimum'] = 0
+
+		calls = []
+
+		async def stage_config(config):
+			calls.append('validation started')
+
+		updater = self.haproxy._service_updater = mock.Mock()
+		updater.needs_update.return_value = True
+		updater.stage_config.side_effect = stage_config
+		updater.is_running.side_effect = lambda: coroutine(True)
+		updater.reload.side_effect = lambda: coroutine(True)
+
+		comm = self.haproxy._comm = mock.Mock()
+		comm.has_socket.return_value = False
+
+		loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		try:
+			with self.subTest("validation runs while haproxy is updated through the socket"):
+				comm.has_socket.return_value = True
+				self.haproxy._incremental_update = lambda *args: calls.append('runtime update') or False
+				try:
+					loop.run_until_complete(self.haproxy.process_update('consul', {}))
+				finally:
+					del self.haproxy._incremental_update
+					comm.has_socket.return_value = False
+
+				self.assertEqual(calls, ['validation started', 'runtime update'])
+				updater.reset_mock()
+				comm.reset_mock()
+
+			loop.run_until_complete(self.haproxy.process_update('consul', {}))
+
+			updater.stage_config.assert_called_once_with(self.haproxy._generate_config())
+			updater.install_config.assert_called_once_with()
+			updater.reload.assert_called_once_with()
+			updater.start.assert_not_called()
+			comm.reset.assert_called_once_with()
+
+			with self.subTest("reload is deferred when budget is exhausted"):
+				self.haproxy._reload_budget = ReloadBudget(1, 0.2)
+				self.haproxy._reload_budget.spend()
+
+				loop.run_until_complete(self.haproxy.process_update('consul', {}))
+				self.assertEqual(updater.reload.call_count, 1)
+				self.assertTrue(self.haproxy._reload_pending)
+
+				# nothing changed since, but the installed config still needs the reload
+				updater.needs_update.return_value = False
+				loop.run_until_complete(asyncio.sleep(0.3))
+				self.assertEqual(updater.reload.call_count, 2)
+				self.assertFalse(self.haproxy._reload_pending)
+		finally:
+			asyncio.set_event_loop(None)
+			loop.close()
+
+	def test_wipe_state(self):
+		comm = self.haproxy._comm = mock.Mock()
+		comm.save_backend_states.return_value = ['service-1', 'stats']
+
+		with tempfile.TemporaryDirectory() as directory:
+			state_dir = self.haproxy._state_dir = Path(directory)
+			for name in ('service-1', 'service-2', 'stats', 'unrelated'):
+				(state_dir / name).write_text('1\n')
+
+			self.haproxy._save_state()
+			self.haproxy._clear_state()
+
+			self.assertEqual([file.name for file in state_dir.iterdir()], ['unrelated'])
+
+	def test_memoized_keys(self):
+		node1 = Node('1.1.1.1', '1234', 'node1', {}, [])
+		node2 = Node('2.2.2.2', '1234', 'node2', {}, [])
+		node3 = Node('3.3.3.3', '1234', 'node3', {}, [])
+		server_id = mock.Mock(return_value=7)
+
+		with mock.patch.object(HAProxy, '_server_id', server_id), mock.patch('winkle.haproxy.log'):
+			with self.subTest("colliding ids are replaced"):
+				keys = self.haproxy._memoized_keys('service-1', [node2, node1])
+				self.assertEqual(keys, {('1.1.1.1', '1234'): (None, 7), ('2.2.2.2', '1234'): (None, 8)})
+
+			with self.subTest("ids are computed only for new nodes"):
+				keys = self.haproxy._memoized_keys('service-1', [node2, node3])
+				self.assertEqual(keys, {('2.2.2.2', '1234'): (None, 8), ('3.3.3.3', '1234'): (None, 7)})
+				self.assertEqual(server_id.call_count, 3)
+
+			with self.subTest("services are independent"):
+				keys = self.haproxy._memoized_keys('service-2', [node2])
+				self.assertEqual(keys, {('2.2.2.2', '1234'): (None, 7)})
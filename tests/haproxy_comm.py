@@ -0,0 +1,193 @@
+import socketserver
+import tempfile
+import threading
+from pathlib import Path
+from unittest import TestCase
+
+from winkle.haproxy_comm import HAProxyComm
+from winkle.haproxy_comm_enums import ServerAdmin, ServerState
+
+RESPONSES = {
+	'show backend': '# name\nservice-1\nservice-2\n',
+	'show servers state service-1': '1\n# be_id be_name srv_id srv_name srv_addr srv_op_state srv_admin_state '
+	                                'srv_uweight srv_iweight srv_time_since_last_change srv_check_status '
+	                                'srv_check_result srv_check_health srv_check_state srv_agent_state '
+	                                'bk_f_forced_id srv_f_forced_id srv_fqdn srv_port\n'
+	                                '3 service-1 1 node1 1.1.1.1 2 1 10 10 64 6 3 4 6 0 0 1 - 1234\n'
+}
+
+class Handler(socketserver.StreamRequestHandler):
+	"""
+	Emulates haproxy stats socket (supports interactive mode and multiple commands separated by ';')
+	"""
+
+	def handle(self):
+		interactive = False
+		requests = 0
+
+		for line in self.rfile:
+			self.server.requests.append(line.decode().rstrip('\n'))
+			requests += 1
+
+			output = ''
+			for command in line.decode().rstrip('\n').split(';'):
+				if command == 'prompt':
+					interactive = not interactive
+					continue
+
+				output += RESPONSES.get(command, '') + '\n'
+
+			if interactive:
+				self.wfile.write((output + '> ').encode())
+
+				# emulates haproxy closing the connection (reload, idle timeout)
+				if requests == self.server.close_after:
+					break
+			else:
+				self.wfile.write(output.encode())
+				break
+
+class HAProxyCommTest(TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.socket = str(Path(self.directory.name) / 'haproxy.sock')
+
+		self.server = socketserver.ThreadingUnixStreamServer(self.socket, Handler)
+		self.server.daemon_threads = True
+		self.server.requests = []
+		self.server.close_after = None
+		threading.Thread(target=self.server.serve_forever, args=(0.01,), daemon=True).start()
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		self.directory.cleanup()
+
+	def test_single_command(self):
+		comm = HAProxyComm(self.socket)
+
+		self.assertTrue(comm.has_socket())
+		self.assertEqual(comm.get_backends(), ['service-1', 'service-2'])
+		self.assertEqual(comm.get_backends(), ['service-1', 'service-2'])
+		self.assertEqual(self.server.requests, ['show backend', 'show backend'])
+
+	def test_persistent(self):
+		comm = HAProxyComm(self.socket, persistent=True)
+
+		self.assertEqual(comm.get_backends(), ['service-1', 'service-2'])
+		state = comm.get_servers_state('service-1')
+		self.assertEqual(list(state), ['node1'])
+		self.assertTrue(comm.is_server_disabled('service-1', 'node1', state))
+
+		comm.reset()
+		self.assertEqual(comm.get_backends(), ['service-1', 'service-2'])
+		self.assertEqual(self.server.requests, ['prompt', 'show backend', 'show servers state service-1',
+		                                        'prompt', 'show backend'])
+		comm.reset()
+
+	def test_batches(self):
+		comm = HAProxyComm(self.socket, persistent=True)
+		servers = [('service-1', 'node%d' % i) for i in range(200)]
+
+		comm.enable_servers(servers)
+		self.assertEqual(self.server.requests[0], 'prompt')
+		self.assertEqual(len(self.server.requests), 2)
+		self.assertEqual(self.server.requests[1].split(';'), ['enable server %s/%s' % server for server in servers])
+
+		# 4000 commands don't fit into a single request
+		comm.disable_servers(servers * 20)
+		self.assertLess(len(self.server.requests), 20)
+		self.assertTrue(all(len(request) < 8192 for request in self.server.requests))
+		comm.reset()
+
+	def test_reconnect(self):
+		comm = HAProxyComm(self.socket, persistent=True)
+		servers = [('service-1', 'node%d' % i) for i in range(200)]
+
+		with self.subTest("connection closed between batches"):
+			# every connection serves a single batch
+			self.server.close_after = 2
+
+			comm.disable_servers(servers * 5)
+			batches = [request for request in self.server.requests if request != 'prompt']
+			self.assertGreater(len(batches), 1)
+			self.assertEqual(sum(len(batch.split(';')) for batch in batches), 1000)
+
+		with self.subTest("socket replaced by a new process"):
+			self.server.close_after = None
+			comm.get_backends()
+
+			# the old process keeps the connection open
+			Path(self.socket).unlink()
+			server = socketserver.ThreadingUnixStreamServer(self.socket, Handler)
+			server.daemon_threads = True
+			server.requests = []
+			server.close_after = None
+			threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+			try:
+				with self.assertLogs('winkle.haproxy_comm', 'INFO'):
+					self.assertEqual(comm.get_backends(), ['service-1', 'service-2'])
+				self.assertEqual(server.requests, ['prompt', 'show backend'])
+			finally:
+				comm.reset()
+				server.shutdown()
+				server.server_close()
+
+		comm.reset()
+
+	def test_slots(self):
+		comm = HAProxyComm(self.socket)
+
+		comm.assign_servers([('service-1', 'slot-1', '1.1.1.1', '1234', 10)])
+		comm.release_servers([('service-1', 'slot-2', '0.0.0.0', '1')])
+		self.assertEqual(self.server.requests, [
+			'set server service-1/slot-1 addr 1.1.1.1 port 1234;set weight service-1/slot-1 10;'
+			'set server service-1/slot-1 state ready',
+			'set server service-1/slot-2 state maint;set server service-1/slot-2 addr 0.0.0.0 port 1'])
+
+		RESPONSES['show servers state'] = RESPONSES['show servers state service-1'] + \
+			'3 service-1 2 winkle-slot-1 1.1.1.2 2 0 10 10 64 6 3 4 6 0 0 1 - 1234\n'
+		try:
+			state_file = Path(self.directory.name) / 'haproxy.state'
+			comm.save_state(state_file, exclude=lambda server: server.startswith('winkle-slot-'))
+			self.assertEqual(state_file.read_text(), RESPONSES['show servers state service-1'])
+		finally:
+			del RESPONSES['show servers state']
+
+	def test_save_backend_states(self):
+		comm = HAProxyComm(self.socket)
+		header = RESPONSES['show servers state service-1'].split('\n')[:2]
+		RESPONSES['show servers state'] = '\n'.join(header + [
+			'3 service-1 1 node1 1.1.1.1 2 1 10 10 64 6 3 4 6 0 0 1 - 1234',
+			'3 service-1 2 winkle-slot-1 0.0.0.0 2 0 10 10 64 6 3 4 6 0 0 1 - 1',
+			'4 service-2 1 node3 3.3.3.3 2 1 10 10 64 6 3 4 6 0 0 1 - 4321'
+		]) + '\n'
+		try:
+			directory = Path(self.directory.name)
+			backends = comm.save_backend_states(directory, exclude=lambda server: server.startswith('winkle-slot-'))
+		finally:
+			del RESPONSES['show servers state']
+
+		self.assertEqual(sorted(backends), ['service-1', 'service-2'])
+		self.assertEqual(sorted(file.name for file in directory.iterdir() if file.is_file()),
+			['service-1', 'service-2'])
+		self.assertEqual((directory / 'service-1').read_text().splitlines(),
+			header + ['3 service-1 1 node1 1.1.1.1 2 1 10 10 64 6 3 4 6 0 0 1 - 1234'])
+		self.assertEqual((directory / 'service-2').read_text().splitlines(),
+			header + ['4 service-2 1 node3 3.3.3.3 2 1 10 10 64 6 3 4 6 0 0 1 - 4321'])
+
+	def test_parse_servers_state(self):
+		response = [
+			'1',
+			'# be_id be_name srv_id srv_name srv_addr srv_op_state srv_admin_state',
+			'3 service-1 1 node1 1.1.1.1 2 1',
+			'3 service-1 2 node2 2.2.2.2 0 0',
+			'4 service-2 1 node3 3.3.3.3 2 0'
+		]
+
+		state = HAProxyComm._parse_servers_state(response)
+		self.assertEqual(list(state), ['service-1', 'service-2'])
+		self.assertEqual(list(state['service-1']), ['node1', 'node2'])
+		self.assertEqual(state['service-2']['node3']['srv_addr'], '3.3.3.3')
+		self.assertEqual(state['service-1']['node2']['srv_op_state'], ServerState.SRV_ST_STOPPED)
+		self.assertEqual(state['service-1']['node1']['srv_admin_state'], (ServerAdmin.SRV_ADMF_FMAINT,))
@@ -0,0 +1,72 @@
+import asyncio
+import tempfile
+from pathlib import Path
+from unittest import TestCase, mock
+
+from winkle.haproxy_master import HAProxyMaster, Process, ReloadError
+
+SHOW_PROC = '''#<PID>          <type>          <relative PID>  <reloads>       <uptime>        <version>
+1000            master          0               {reloads}               0d00h02m07s     2.4.0
+# workers
+{worker}            worker          1               0               0d00h00m00s     2.4.0
+# old workers
+1233            worker          [was: 1]        1               0d00h00m28s     2.4.0
+# programs
+
+'''
+
+class HAProxyMasterTest(TestCase):
+	def setUp(self):
+		self.loop = asyncio.new_event_loop()
+		self.directory = tempfile.TemporaryDirectory()
+		self.socket = str(Path(self.directory.name) / 'master.sock')
+
+		self.requests = []
+		self.reloads = 0
+		self.worker = 1271
+		self.failure = None
+		self.server = self.loop.run_until_complete(asyncio.start_unix_server(self.handle, self.socket))
+
+	def tearDown(self):
+		self.server.close()
+		self.loop.run_until_complete(self.server.wait_closed())
+		self.loop.close()
+		self.directory.cleanup()
+
+	async def handle(self, reader, writer):
+		command = (await reader.readline()).decode().strip()
+		self.requests.append(command)
+
+		if command == 'show proc':
+			writer.write(SHOW_PROC.format(reloads=self.reloads, worker=self.worker).encode())
+		elif command == 'reload' and self.failure is None:
+			self.reloads += 1
+			# the new worker shows up a bit later
+			self.loop.call_later(0.15, setattr, self, 'worker', self.worker + 1)
+		elif command == 'reload':
+			writer.write(self.failure.encode())
+
+		writer.close()
+
+	def test_parse_proc(self):
+		self.assertEqual(HAProxyMaster._parse_proc(SHOW_PROC.format(reloads=1, worker=1271).splitlines()), [
+			Process(1000, 'master', False),
+			Process(1271, 'worker', False),
+			Process(1233, 'worker', True)
+		])
+
+	def test_reload(self):
+		master = HAProxyMaster(self.socket, timeout=1)
+
+		with self.subTest("waits for the new worker"), mock.patch('winkle.haproxy_master.POLL_INTERVAL', 0.01):
+			self.assertEqual(self.loop.run_until_complete(master.workers()), [1271])
+
+			duration = self.loop.run_until_complete(master.reload())
+			self.assertGreaterEqual(duration, 0.15)
+			self.assertEqual(self.loop.run_until_complete(master.workers()), [1272])
+			self.assertEqual(self.requests[:3], ['show proc', 'show proc', 'reload'])
+
+		with self.subTest("reload fails"):
+			self.failure = 'Success=0\n--\n[ALERT] config invalid\n'
+			with self.assertRaises(ReloadError):
+				self.loop.run_until_complete(master.reload())
@@ -0,0 +1,31 @@
+from unittest import TestCase
+
+from winkle.reload_budget import ReloadBudget
+
+class ReloadBudgetTest(TestCase):
+	def test_budget(self):
+		now = [0.0]
+		budget = ReloadBudget(2, 60, timer=lambda: now[0])
+
+		self.assertEqual(budget.delay(), 0)
+		budget.spend()
+		now[0] = 10
+		self.assertEqual(budget.delay(), 0)
+		budget.spend()
+
+		# both reloads are within the window
+		now[0] = 20
+		self.assertEqual(budget.delay(), 40)
+
+		# the first one slid out of it
+		now[0] = 60
+		self.assertEqual(budget.delay(), 0)
+		budget.spend()
+		self.assertEqual(budget.delay(), 10)
+
+	def test_unlimited(self):
+		budget = ReloadBudget(0, 60)
+		for _ in range(100):
+			budget.spend()
+
+		self.assertEqual(budget.delay(), 0)
@@ -1,4 +1,7 @@
+import asyncio
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from unittest.mock import patch, mock_open
 
@@ -68,3 +71,49 @@ class RouterTest(unittest.TestCase):
 		self.assertEqual(source, 'consul')
 		self.assertEqual(len(services), 1)
 		self.assertEqual(services[0], 'consul-service-1')
+
+	def testSingleLoop(self):
+		config = {
+			'program': {
+				'services-config': {}
+			},
+			'sources': {
+				'consul': {}
+			},
+			'sinks': {
+				'haproxy': {
+					'service': {
+						'config': 'haproxy.cfg',
+						'check-config': 'haproxy -c -f {file}',
+						'status': 'service haproxy status',
+						'start': 'service haproxy start',
+						'reload': 'service haproxy reload',
+						'pid-file': '/var/run/haproxy.pid',
+						'state-file': '/var/lib/haproxy.state',
+						'socket': '/var/lib/haproxy.sock'
+					},
+					'services': []
+				}
+			}
+		}
+
+		class yamlresult:
+			_data = {}
+
+		with patch('yamlcfg.YamlConfig', return_value = yamlresult()):
+			router = Router(config)
+
+		loop = asyncio.new_event_loop()
+		router._loop, router._loop_thread = loop, threading.get_ident()
+		router._executor = ThreadPoolExecutor(max_workers=1)
+
+		try:
+			# called from the loop thread, so the task is scheduled directly
+			task = router.run_main_thread(lambda: router.run_blocking(threading.get_ident))
+			self.assertIsInstance(task, asyncio.Task)
+
+			# blocking part was executed by a worker thread
+			self.assertNotEqual(loop.run_until_complete(task), threading.get_ident())
+		finally:
+			router._executor.shutdown()
+			loop.close()
@@ -0,0 +1,99 @@
+import asyncio
+import os
+import tempfile
+from pathlib import Path
+from unittest import TestCase, mock
+
+from winkle.service_updater import ServiceUpdater
+
+class ServiceUpdaterTest(TestCase):
+	def setUp(self):
+		self.loop = asyncio.new_event_loop()
+		self.directory = tempfile.TemporaryDirectory()
+		self.config_file = Path(self.directory.name) / 'haproxy.cfg'
+
+		self.updater = ServiceUpdater({
+			'config': str(self.config_file),
+			'pid-file': str(Path(self.directory.name) / 'haproxy.pid'),
+			'check-config': 'true',
+			'status': 'false',
+			'start': 'true',
+			'reload': 'true'
+		})
+
+	def tearDown(self):
+		self.loop.close()
+		self.directory.cleanup()
+
+	def run_loop(self, coroutine):
+		return self.loop.run_until_complete(coroutine)
+
+	def test_needs_update(self):
+		self.assertTrue(self.updater.needs_update(b'config 1'))
+
+		self.run_loop(self.updater.update_config(b'config 1'))
+		self.assertEqual(self.config_file.read_bytes(), b'config 1')
+
+		with mock.patch.object(Path, 'open', side_effect=AssertionError("file shouldn't be read")):
+			self.assertFalse(self.updater.needs_update(b'config 1'))
+			self.assertTrue(self.updater.needs_update(b'config 2'))
+
+		with self.subTest("file modified on disk"):
+			self.config_file.write_bytes(b'config 2')
+			os.utime(str(self.config_file), ns=(0, 0))
+			self.assertFalse(self.updater.needs_update(b'config 2'))
+			self.assertTrue(self.updater.needs_update(b'config 1'))
+
+		with self.subTest("file removed"):
+			self.config_file.unlink()
+			self.assertTrue(self.updater.needs_update(b'config 2'))
+
+	def test_commands(self):
+		pidfile = Path(self.directory.name) / 'haproxy.pid'
+
+		with self.subTest("status command is used without pid file"):
+			self.assertFalse(self.run_loop(self.updater.is_running()))
+
+		with self.subTest("running process is found in /proc"):
+			pidfile.write_text('%d\n' % os.getpid())
+			self.assertTrue(self.run_loop(self.updater.is_running()))
+
+		with self.subTest("placeholders"):
+			self.assertEqual(self.updater._command_args("haproxy -f '{config}' -sf {pid}"),
+				['haproxy', '-f', str(self.config_file), '-sf', str(os.getpid())])
+
+			pidfile.unlink()
+			self.assertEqual(self.updater._command_args('haproxy -p {pidfile} -sf {pid}'),
+				['haproxy', '-p', str(pidfile), '-sf'])
+
+		with self.subTest("timeout"):
+			self.updater._timeout = 0.1
+			with self.assertLogs('winkle.service_updater', 'ERROR'):
+				self.assertFalse(self.run_loop(self.updater._execute('sleep 10')))
+			self.assertTrue(self.run_loop(self.updater._execute('test {config} = {file}', file=str(self.config_file))))
+
+	def test_kill(self):
+		self.updater._timeout = 0.1
+
+		with self.subTest("process which can't be killed"):
+			with mock.patch.object(asyncio.subprocess.Process, 'kill', side_effect=PermissionError(1, 'not permitted')), \
+					self.assertLogs('winkle.service_updater', 'WARNING'):
+				self.assertFalse(self.run_loop(self.updater._execute('sleep 0.3')))
+
+			# it is reaped once it finishes
+			self.run_loop(asyncio.sleep(0.5))
+
+		with self.subTest("cancelled command is killed"):
+			async def cancel():
+				with mock.patch.object(asyncio.subprocess.Process, 'kill', autospec=True,
+						side_effect=asyncio.subprocess.Process.kill) as kill:
+					task = asyncio.ensure_future(self.updater._execute('sleep 10'))
+					await asyncio.sleep(0.05)
+					task.cancel()
+					with self.assertRaises(asyncio.CancelledError):
+						await task
+
+					process = kill.call_args[0][0]
+					return await asyncio.wait_for(process.wait(), 1)
+
+			self.assertNotEqual(self.run_loop(cancel()), 0)
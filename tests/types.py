@@ -0,0 +1,35 @@
+from unittest import TestCase
+
+from winkle.types import hashabledict, InternPool, Node
+
+class Types(TestCase):
+	def test_hashabledict(self):
+		attrs = hashabledict(rack='ab-c', weight='10')
+
+		with self.subTest("equality doesn't depend on order"):
+			self.assertEqual(attrs, hashabledict(weight='10', rack='ab-c'))
+			self.assertEqual(hash(attrs), hash(hashabledict(weight='10', rack='ab-c')))
+			self.assertNotEqual(attrs, hashabledict(rack='ab-c'))
+
+		with self.subTest("is immutable"):
+			with self.assertRaises(TypeError):
+				attrs['weight'] = '20'
+
+	def test_intern_pool(self):
+		pool = InternPool(maxsize=2)
+		tags = pool(frozenset(['a', 'b']))
+
+		self.assertIs(pool(frozenset(['b', 'a'])), tags)
+
+		pool(frozenset(['c']))
+		pool(frozenset(['d']))
+		self.assertEqual(len(pool), 1)
+
+	def test_node_create(self):
+		node1 = Node.create('1.1.1.1', 1234, 'node1', {'rack': 'ab-c'}, ['a', 'b'])
+		node2 = Node.create('2.2.2.2', 1234, 'node2', {'rack': 'ab-c'}, ['b', 'a'])
+
+		self.assertIsInstance(node1.attrs, hashabledict)
+		self.assertIs(node1.attrs, node2.attrs)
+		self.assertIs(node1.tags, node2.tags)
+		self.assertEqual(node1, Node('1.1.1.1', 1234, 'node1', hashabledict(rack='ab-c'), frozenset(['a', 'b'])))
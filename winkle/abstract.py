@@ -1,7 +1,8 @@
+import asyncio
 from abc import abstractmethod, ABCMeta
 from typing import Any, Callable, Dict, List, Optional, Tuple, Mapping
 
-from .types import T_CHANGES, Node
+from .types import T_CHANGES, Node, Snapshot
 
 T_SERVICES = Dict[str, List[str]]
 
@@ -18,7 +19,11 @@ class AbsSourceSink(metaclass=ABCMeta):
 
 class AbsSource(AbsSourceSink):
 	@abstractmethod
-	def start(self) -> None:
+	def start(self, loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+		"""
+		Starts the source
+		:param loop: event loop to run in; when not provided the source runs in its own thread
+		"""
 		pass
 
 	def services_needed(self) -> List[str]:
@@ -29,18 +34,27 @@ class AbsSource(AbsSourceSink):
 		assert self._hooks, 'set_hooks() was not called'
 		return self._hooks['change_detected'](self._service_id, changes)
 
+	def discovery_options(self, service: str) -> Mapping[str, Any]:
+		assert self._hooks, 'set_hooks() was not called'
+		return self._hooks['discovery_options'](self._service_id, service)
+
 class AbsSink(AbsSourceSink):
 	@abstractmethod
 	def services_needed(self) -> T_SERVICES:
 		pass
 
 	@abstractmethod
-	def process_update(self, source: str, changes: T_CHANGES) -> None:
+	async def process_update(self, source: str, changes: T_CHANGES) -> None:
 		pass
 
-	def service_nodes(self, service_name: str, data_centers: Optional[str]) -> List[Node]:
+	def snapshot(self) -> Dict[str, Snapshot]:
+		assert self._hooks, 'set_hooks() was not called'
+		return self._hooks['snapshot']()
+
+	def service_nodes(self, service_name: str, data_centers: Optional[str],
+			snapshots: Optional[Mapping[str, Snapshot]] = None) -> List[Node]:
 		assert self._hooks, 'set_hooks() was not called'
-		return self._hooks['service_nodes'](service_name, data_centers)
+		return self._hooks['service_nodes'](service_name, data_centers, snapshots)
 
 	def service2sources(self, canonical_service: str, data_centers: Optional[str]) -> Tuple[str, List[str]]:
 		assert self._hooks, 'set_hooks() was not called'
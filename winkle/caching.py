@@ -1,48 +1,86 @@
 import asyncio
 import functools
+import inspect
 import logging
 import time
+from typing import Any, Dict, Iterable, MutableMapping, Optional, Tuple
 
 import cachetools
 
 log = logging.getLogger(__name__)
 
-def async_index_cache(cache):
+def async_index_cache(cache: MutableMapping, ignore: Iterable[str] = ('index', 'wait')):
+	"""
+	Caches results of a coroutine implementing a Consul blocking query. The coroutine needs to accept `index`
+	argument and return a tuple with X-Consul-Index as its first element.
+
+	- entries are keyed by the arguments, except the ones listed in `ignore`
+	- a call with an index is served from the cache when the cached index is newer
+	- a call without an index is served from the cache while a blocking query is watching the cached index
+	- concurrent calls with the same key and index share a single request
+	- an index that went backwards (Consul reset it) replaces the cached entry
+
+	:param cache: mapping used to store the entries
+	:param ignore: names of arguments which are not part of the key
+	"""
+
+	ignore = frozenset(ignore)
+
 	def decorator(func):
-		lock = asyncio.Lock()
+		signature = inspect.signature(func)
+		in_flight = {}  # type: Dict[Tuple[Any, Optional[int]], asyncio.Future]
+
+		async def fetch(k, req_index: Optional[int], args, kwargs):
+			v = await func(*args, **kwargs)
+			index = int(v[0])
+
+			cached = cache.get(k)
+			if cached is None or index >= cached[0] or (req_index is not None and index < req_index):
+				try:
+					cache[k] = index, v
+				except ValueError:
+					pass  # value too large
 
-		try:
-			index_pos = func.__code__.co_varnames.index('index')
-		except ValueError:
-			index_pos = None
+			return v
+
+		def consume(task: asyncio.Future) -> None:
+			# nobody might be waiting for the result anymore
+			if not task.cancelled():
+				task.exception()
 
 		async def wrapper(*args, **kwargs):
-			k = cachetools.hashkey(*args, **kwargs)
+			arguments = signature.bind(*args, **kwargs).arguments
+			k = tuple((name, value) for name, value in arguments.items() if name not in ignore)
 
 			# Figure out index value from the arguments
-			req_index = kwargs.get('index')
-			if req_index is None and index_pos is not None and index_pos < len(args):
-				req_index = args[index_pos]
+			req_index = arguments.get('index')
+			req_index = int(req_index) if req_index is not None else None
 
-			async with lock:
-				index, value = cache.get(k, (0, None))
+			cached = cache.get(k)
+			if cached is not None:
+				index, value = cached
 
-			if value is not None:
-				if req_index is None or int(req_index) < index:
-					log.debug("Cache hit (index %d)", index)
+				if req_index is None and (k, index) in in_flight:
+					log.debug("Cache hit (index %d is being watched)", index)
 					return value
 
-			log.debug("Cache miss; requesting data")
-			v = await func(*args, **kwargs)
-			index = int(v[0])
+				if req_index is not None and req_index < index:
+					log.debug("Cache hit (index %d)", index)
+					return value
 
-			try:
-				async with lock:
-					cache[k] = index, v
-			except ValueError:
-				pass  # value too large
+			flight = k, req_index
+			task = in_flight.get(flight)
+			if task is None:
+				log.debug("Cache miss; requesting data")
+				task = asyncio.ensure_future(fetch(k, req_index, args, kwargs))
+				task.add_done_callback(consume)
+				task.add_done_callback(lambda _: in_flight.pop(flight, None))
+				in_flight[flight] = task
+			else:
+				log.debug("Cache miss; joining request in flight")
 
-			return v
+			# cancellation of one caller shouldn't affect the others
+			return await asyncio.shield(task)
 
 		functools.update_wrapper(wrapper, func)
 		return wrapper
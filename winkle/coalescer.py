@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from .diff import merge_service_changes
+from .types import T_CHANGES
+
+log = logging.getLogger(__name__)
+
+class Coalescer:
+	"""
+	Collects changes and releases them in batches. A batch is released once its services didn't change for their
+	quiet period, or when the oldest change was held for the maximum delay (0 means changes are held for as long as they
+	keep coming). Changes of the same service are merged.
+	"""
+
+	def __init__(self, callback: Callable[[str, T_CHANGES], Any], delays: Callable[[str], Tuple[float, float]],
+			timer: Callable[[], float] = time.monotonic):
+		"""
+		:param callback: function receiving source name and merged changes
+		:param delays: function returning quiet period and maximum delay (in seconds) for a service
+		:param timer: clock used to measure delays
+		"""
+		self._callback = callback
+		self._delays = delays
+		self._timer = timer
+
+		self._pending = {}  # type: Dict[str, T_CHANGES]
+		self._first = {}    # type: Dict[str, float]
+		self._last = {}     # type: Dict[str, float]
+		self._handle = None  # type: Optional[asyncio.Handle]
+
+	def submit(self, source: str, changes: T_CHANGES) -> None:
+		"""
+		Adds changes to the pending batch (needs to be called from the event loop)
+		:param source: name of the source
+		:param changes: changes detected by the source
+		"""
+		now = self._timer()
+
+		merge_service_changes(self._pending.setdefault(source, {}), changes)
+		for service in changes:
+			self._first.setdefault(service, now)
+			self._last[service] = now
+
+		delay = max(0.0, self._deadline() - now)
+		log.debug("Holding changes of %s for %.3fs", ", ".join(changes), delay)
+
+		if self._handle:
+			self._handle.cancel()
+		self._handle = asyncio.get_event_loop().call_later(delay, self.flush)
+
+	def flush(self) -> None:
+		"""
+		Releases pending changes
+		"""
+		if self._handle:
+			self._handle.cancel()
+			self._handle = None
+
+		pending, self._pending = self._pending, {}
+		self._first.clear()
+		self._last.clear()
+
+		for source, changes in pending.items():
+			self._callback(source, changes)
+
+	def _deadline(self) -> float:
+		deadline = None
+		for service, last in self._last.items():
+			quiet, maximum = self._delays(service)
+			service_deadline = last + quiet
+			if maximum > 0:
+				service_deadline = min(service_deadline, self._first[service] + maximum)
+
+			if deadline is None or service_deadline < deadline:
+				deadline = service_deadline
+
+		return deadline
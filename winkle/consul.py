@@ -1,35 +1,150 @@
 import asyncio
+import hashlib
+import json
 import logging
+import time
 import urllib.parse
+from asyncio import ensure_future
 from enum import Enum
-from typing import Any, Mapping, Optional, Tuple
+from typing import Any, Callable, Iterable, List, Mapping, Optional, Tuple, Union
 
 import aiohttp
 
+from .caching import async_ttl_cache
 from .errors import ConnectionError, UnhandledException, HTTPResponseError, Error
 
 log = logging.getLogger(__name__)
 
+# how long a health check of an agent can take, in seconds
+CHECK_TIMEOUT = 5
+
+# consul waits 5 minutes when a blocking query doesn't specify the wait and at most 10 minutes, it also adds up to
+# wait/16 of jitter
+DEFAULT_WAIT = 300
+MAX_WAIT = 600
+
+# time on top of the wait a response can take to arrive, in seconds
+REQUEST_TIMEOUT_MARGIN = 15
+
+# units of durations (go syntax) used in the wait parameter, in seconds
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
 class Consistency(Enum):
 	Default = 1
 	Consistent = 2
 	Stale = 3
 
+class Payload:
+	"""
+	Body of a response from Consul; decoding is done only when needed, so unchanged responses can be skipped
+	by comparing their digests
+	"""
+	__slots__ = ('body', 'cache_hit', 'age', '_digest', '_data', '_projected')
+
+	def __init__(self, body: bytes, cache_hit: Optional[bool] = None, age: Optional[int] = None):
+		"""
+		:param body: body of the response
+		:param cache_hit: whether the response was served from the agent cache (None when the cache wasn't used)
+		:param age: how old the cached response is, in seconds
+		"""
+		self.body = body
+		self.cache_hit = cache_hit
+		self.age = age
+		self._digest = None  # type: Optional[bytes]
+		self._data = None    # type: Any
+		self._projected = None  # type: Optional[List[Any]]
+
+	@property
+	def digest(self) -> bytes:
+		if self._digest is None:
+			self._digest = hashlib.blake2b(self.body, digest_size=16).digest()
+
+		return self._digest
+
+	def json(self) -> Any:
+		if self._data is None:
+			self._data = json.loads(self.body.decode('utf-8'))
+
+		return self._data
+
+	def project(self, projection: Callable[[Any], Any]) -> List[Any]:
+		"""
+		Extracts needed fields from every entry of the response; the decoded document is released afterwards, only
+		the projected entries are kept (responses are cached)
+		:param projection: function extracting fields from an entry
+		:return: list of projected entries
+		"""
+		if self._projected is None:
+			self._projected = [projection(entry) for entry in self.json()]
+			self._data = None
+
+		return self._projected
+
+class Agent:
+	"""
+	Consul agent requests can be sent to
+	"""
+	__slots__ = ('url', 'failed', '_lost')
+
+	def __init__(self, url: str):
+		self.url = url
+		self.failed = None  # type: Optional[float]
+		self._lost = None   # type: Optional[asyncio.Future]
+
+	@property
+	def lost(self) -> asyncio.Future:
+		"""
+		Future which is resolved when the agent fails; requests in flight wait for it, so they can be aborted
+		"""
+		if self._lost is None:
+			self._lost = asyncio.get_event_loop().create_future()
+
+		return self._lost
+
+	def fail(self) -> None:
+		self.failed = time.monotonic()
+		if not self.lost.done():
+			self.lost.set_result(None)
+
+	def recover(self) -> None:
+		# requests in flight keep waiting for the current future, it is replaced only after a failure
+		if self.failed is not None:
+			self.failed = None
+			self._lost = None
+
 class Consul:
 	def __init__(self, host: str='127.0.0.1', port: str='8500', scheme: str='http',
-			consistency: Consistency=Consistency.Default, limit: Optional[int]=10):
+			consistency: Consistency=Consistency.Default, limit: Optional[int]=10, agent_cache: bool=False,
+			max_age: Optional[int]=None, compress: bool=True, agents: Iterable[Tuple[str, str]]=()):
+		"""
+		:param agent_cache: let the local agent answer from its cache instead of forwarding requests to servers
+		:param max_age: maximum age (in seconds) of a response served from the agent cache
+		:param compress: ask for gzip compressed responses
+		:param agents: additional agents (host, port) used when the preceding ones are unavailable
+		"""
 
 		self._host = host
 		self._port = port
 		self._scheme = scheme
 		self._consistency = consistency
 		self._limit = limit
+		self._agent_cache = agent_cache
+		self._max_age = max_age
+
+		self._headers = {'Accept-Encoding': 'gzip' if compress else 'identity'}
+		if agent_cache and max_age is not None:
+			self._headers['Cache-Control'] = 'max-age=%d' % max_age
 
-		self._base_url = '%s://%s:%s' % (self._scheme, self._host, self._port)
+		# agents in order of preference
+		self._agents = [Agent('%s://%s:%s' % (self._scheme, agent_host, agent_port))
+			for agent_host, agent_port in [(host, port)] + list(agents)]
 
 		connector = aiohttp.TCPConnector(limit=limit)
 		self._session = aiohttp.ClientSession(connector=connector)
 
+		# health checks have their own connections, so they aren't queued behind blocking queries
+		self._check_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=len(self._agents)))
+
 		self.health = Health(self)
 
 	def consistency(self, params: dict, consistency: Optional[Consistency]=None) -> None:
@@ -41,6 +156,11 @@ class Consul:
 		elif consistency == Consistency.Stale:
 			params.update({'Stale': 'true'})
 
+	def cached(self, params: dict) -> None:
+		# consistent reads always need to go to the leader
+		if self._agent_cache and 'Consistent' not in params:
+			params.update({'cached': ''})
+
 	@staticmethod
 	def blocking(params: dict, index: Optional[str], wait: Optional[str]) -> None:
 		if index:
@@ -48,6 +168,24 @@ class Consul:
 			if wait:
 				params.update({'wait': wait})
 
+	@staticmethod
+	def next_index(index: Optional[str], new_index: str) -> str:
+		"""
+		Sanitizes X-Consul-Index received from a blocking query (as recommended by Consul documentation)
+		:param index: index which was used in the request
+		:param new_index: index returned by Consul
+		:return: index to use in the next request; '0' when the index went backwards (the next request returns
+		         immediately) and at least '1' otherwise
+		"""
+		if index is not None and int(new_index) < int(index):
+			log.warning("Consul index went backwards (%s -> %s); resetting", index, new_index)
+			return '0'
+
+		if int(new_index) < 1:
+			return '1'
+
+		return new_index
+
 	@staticmethod
 	def data_center(name: str) -> Tuple[Optional[str], str]:
 		"""
@@ -65,28 +203,106 @@ class Consul:
 
 		return dc_service[0], dc_service[1]
 
-	async def get(self, path: str, params: Optional[dict]=None) -> Tuple[Mapping[str, str], Mapping[str, Any]]:
+	async def get(self, path: str, params: Optional[Union[dict, Iterable[Tuple[str, str]]]]=None) \
+			-> Tuple[Mapping[str, str], Payload]:
 		"""
-		Makes a get request to consul and returns headers and json response
+		Makes a get request to consul and returns headers and the response body; when an agent can't be connected
+		to (or fails while the request is in flight) the request is repeated right away with the next agent, with the
+		same parameters (a blocking query continues from the same index, which is shared by all agents of a data
+		center). Error responses are specific to the request (e.g. unreachable data center), they don't fail the agent.
 		:param path: path for the request
 		:param params: dictionary of parameters
-		:return: tuple containing a headers object and json converted to python dictionary/list
+		:return: tuple containing a headers object and payload with the json response
 		:raises ConnectionError when connection was unable to connect to Consul
 		:raises HTTPResponseError when received an unexpected response from Consul
 		:raises UnhandledException for any exception that was not anticipated
 		"""
+		if params is not None and not isinstance(params, dict):
+			params = list(params)
+
+		error = None  # type: Optional[Error]
+		for agent in self.agents():
+			try:
+				result = await self._request(agent, path, params)
+			except ConnectionError as e:
+				error = e
+			else:
+				agent.recover()
+				return result
 
-		url = urllib.parse.urljoin(self._base_url, path)
+			self._fail(agent, error)
 
+		raise error
+
+	def agents(self) -> List[Agent]:
+		"""
+		Returns agents in the order they should be tried; available agents go first (in order of preference), the
+		failed ones are tried last, starting with the one which failed first
+		"""
+		return [agent for agent in self._agents if agent.failed is None] + \
+			sorted((agent for agent in self._agents if agent.failed is not None), key=lambda agent: agent.failed)
+
+	def _fail(self, agent: Agent, reason: Any) -> None:
+		"""
+		Marks the agent as failed, which aborts requests in flight to it; with a single agent there is nowhere to fail
+		over to, so its requests are left alone
+		"""
+		if len(self._agents) < 2:
+			return
+
+		if agent.failed is None:
+			log.warning("Consul agent %s is unavailable (%s); failing over", agent.url, reason)
+		agent.fail()
+
+	async def _request(self, agent: Agent, path: str, params: Optional[Union[dict, List[Tuple[str, str]]]]) \
+			-> Tuple[Mapping[str, str], Payload]:
+		"""
+		Sends the request to the agent; the request is aborted when the agent fails in the meantime (its health check
+		failed), so a query blocked on a dead agent doesn't need to wait for its timeout
+		"""
+		request = ensure_future(self._fetch(urllib.parse.urljoin(agent.url, path), params))
 		try:
-			async with self._session.get(url, params=params, timeout=330) as resp:  # type: aiohttp.client_reqrep.ClientResponse
+			if agent.failed is None:
+				await asyncio.wait({request, agent.lost}, return_when=asyncio.FIRST_COMPLETED)
+			else:
+				await asyncio.wait({request})
+		except asyncio.CancelledError:
+			request.cancel()
+			raise
+
+		if not request.done():
+			request.cancel()
+			raise ConnectionError("Consul agent %s failed during the request" % agent.url)
+
+		return request.result()
+
+	@staticmethod
+	def request_timeout(params: Optional[Union[dict, List[Tuple[str, str]]]]) -> float:
+		"""
+		Calculates timeout of a request, so a blocking query isn't timed out before consul answers it
+		:param params: parameters of the request
+		:return: timeout, in seconds
+		"""
+		wait = (params.get('wait') if isinstance(params, dict) else dict(params or ()).get('wait'))
+		seconds = DEFAULT_WAIT
+		if wait:
+			number = wait.rstrip('hms')
+			seconds = min(MAX_WAIT, float(number) * DURATION_UNITS.get(wait[len(number):] or 's', 1))
+
+		return seconds * 17 / 16 + REQUEST_TIMEOUT_MARGIN
+
+	async def _fetch(self, url: str, params: Optional[Union[dict, List[Tuple[str, str]]]]) \
+			-> Tuple[Mapping[str, str], Payload]:
+		try:
+			async with self._session.get(url, params=params, headers=self._headers,
+					timeout=self.request_timeout(params)) as resp:  # type: aiohttp.client_reqrep.ClientResponse
 				if resp.status != 200:
 					raise HTTPResponseError(resp.status, resp.reason, await resp.text())
 
 				if resp.headers['content-type'] != 'application/json':
 					raise HTTPResponseError(resp.status, resp.reason, await resp.text())
 
-				return resp.headers, await resp.json()
+				return resp.headers, Payload(await resp.read(), *self.cache_status(resp.headers))
 
 		except (aiohttp.ClientResponseError, aiohttp.ClientOSError, aiohttp.client_exceptions.ServerDisconnectedError, asyncio.TimeoutError) as e:
 			raise ConnectionError(e) from e
@@ -95,18 +311,69 @@ class Consul:
 		except Exception as e:
 			raise UnhandledException('Got an unexpected exception') from e
 
+	@staticmethod
+	def cache_status(headers: Mapping[str, str]) -> Tuple[Optional[bool], Optional[int]]:
+		"""
+		Extracts agent cache information from headers of a response
+		:return: tuple containing whether the response was a cache hit and its age (None when not cached)
+		"""
+		cache = headers.get('X-Cache')
+		if cache is None:
+			return None, None
+
+		age = headers.get('Age')
+
+		return cache == 'HIT', int(age) if age is not None else None
+
+	async def check_agents(self) -> int:
+		"""
+		Checks that agents respond and know the cluster leader; failed agents are put back into use once they pass,
+		requests in flight to agents which don't pass are aborted and sent to other agents. Regular checks also keep
+		connections to all agents open.
+		:return: number of available agents
+		"""
+		async def check(agent: Agent) -> bool:
+			try:
+				async with self._check_session.get(urllib.parse.urljoin(agent.url, '/v1/status/leader'),
+						timeout=CHECK_TIMEOUT) as resp:  # type: aiohttp.client_reqrep.ClientResponse
+					leader = await resp.json() if resp.status == 200 else None
+			except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+				self._fail(agent, repr(e))
+				return False
+
+			if not leader:
+				self._fail(agent, 'no cluster leader')
+				return False
+
+			if agent.failed is not None:
+				log.info("Consul agent %s is available again", agent.url)
+				agent.recover()
+
+			return True
+
+		return sum(await asyncio.gather(*[check(agent) for agent in self._agents]))
+
 	def close(self) -> None:
 		"""
 		Closes the current session
 		"""
 		self._session.close()
+		self._check_session.close()
 
 class Health:
 	def __init__(self, agent: Consul):
 		self._agent = agent
 
+	# noinspection PyShadowingBuiltins
+	@async_ttl_cache(maxsize=4096)
 	async def service(self, service: str, index: str = None, wait: str = None,
-			passing: bool = None, consistency: Consistency = None) -> Tuple[str, Mapping[str, Any]]:
+			passing: bool = None, consistency: Consistency = None, tags: Tuple[str, ...] = (),
+			filter: Optional[str] = None) -> Tuple[str, Payload]:
+		"""
+		Obtains health entries of a service
+		:param tags: only return instances having all of these tags
+		:param filter: filter expression evaluated by consul (requires consul 1.5 or newer)
+		"""
 
 		params = {}
 		dc, service = self._agent.data_center(service)
@@ -114,12 +381,16 @@ class Health:
 			params['dc'] = dc
 
 		self._agent.consistency(params, consistency)
+		self._agent.cached(params)
 		self._agent.blocking(params, index, wait)
 		if passing:
 			params['passing'] = 'true'
+		if filter:
+			params['filter'] = filter
 
 		path = urllib.parse.urljoin('/v1/health/service/', urllib.parse.quote(service))
 
-		headers, data = await self._agent.get(path, params)
+		# tag parameter can be repeated
+		headers, data = await self._agent.get(path, list(params.items()) + [('tag', tag) for tag in tags])
 
-		return headers['x-consul-index'], data
+		return self._agent.next_index(index, headers['x-consul-index']), data
@@ -1,18 +1,30 @@
 import asyncio
+import functools
+import json
 import logging
+import os
+import random
 import threading
 from asyncio import CancelledError, ensure_future
 from contextlib import closing
-from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple, Union
 from warnings import warn
 
 from .abstract import AbsSource
-from .consul import Consul
+from .consul import Consul, Payload
+from .diff import service_changes
 from .errors import ConnectionError, HTTPResponseError
-from .types import hashabledict, Node, NodeAddr, T_CHANGES, Changes
+from .types import hashabledict, intern_attrs, intern_tags, Node, Snapshot, T_CHANGES
 
 log = logging.getLogger(__name__)
 
+# service -> (digest of the response, list of nodes or None when the response didn't change)
+T_STATE_UPDATE = Dict[str, Tuple[bytes, Optional[List[Node]]]]
+
+# version of the format of the state file
+STATE_VERSION = 1
+
 class ConsulListener(AbsSource):
 	_consul = Consul
 	_local = threading.local()
@@ -21,10 +33,24 @@ class ConsulListener(AbsSource):
 		super().__init__('consul', config['sources']['consul'])
 
 		self._loop = None           # type: Optional[asyncio.BaseEventLoop]
-		self._listener_task = None  # type: Optional[threading.Thread]
+		self._listener_task = None  # type: Optional[Union[threading.Thread, asyncio.Task]]
 		self.__control_lock = threading.Lock()
 
-	def start(self) -> None:
+		# number of responses with a new index but unchanged content
+		self._suppressed_updates = 0
+
+		# responses served by the agent cache
+		self._agent_cache_hits = 0
+		self._agent_cache_misses = 0
+
+		# published state of services (replaced as a whole, so other threads can read it without locking)
+		self._snapshot = Snapshot(0, {})
+
+		# last known state is kept here, so it can be used right after restart
+		state_file = self._config.get('state-file')
+		self._state_file = Path(state_file) if state_file else None  # type: Optional[Path]
+
+	def start(self, loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
 		assert self._hooks is not None
 
 		def monitor_thread() -> None:
@@ -36,26 +62,28 @@ class ConsulListener(AbsSource):
 				with self.__control_lock:
 					self._loop = loop
 
-				while True:
-					# noinspection PyBroadException
-					try:
-						loop.run_until_complete(self._monitor())
-					except:
-						log.exception("Unhandled exception in the consul thread (THIS IS A BUG, PLEASE REPORT);"
-						              "restarting asyncio monitor ...")
-					else:
-						break
+				loop.run_until_complete(self._supervise())
 
 		with self.__control_lock:
 			if self._listener_task:
-				if self._listener_task.is_alive():
+				if isinstance(self._listener_task, threading.Thread):
+					running = self._listener_task.is_alive()
+				else:
+					running = not self._listener_task.done()
+
+				if running:
 					warn("listener is already running", RuntimeWarning)
 					return
 				else:
 					log.warning("listener was not running, restarting")
 
-			self._listener_task = threading.Thread(target=monitor_thread, name='consul-monitor', daemon=True)
-			self._listener_task.start()
+			if loop:
+				# single loop mode, the monitor runs as a task in provided loop
+				self._loop = loop
+				self._listener_task = loop.create_task(self._supervise())
+			else:
+				self._listener_task = threading.Thread(target=monitor_thread, name='consul-monitor', daemon=True)
+				self._listener_task.start()
 
 	def stop(self):
 		raise NotImplementedError()
@@ -76,14 +104,107 @@ class ConsulListener(AbsSource):
 
 		return monitors
 
+	async def _supervise(self) -> None:
+		"""
+		Runs the monitor, restarting it when it fails
+		"""
+		while True:
+			# noinspection PyBroadException
+			try:
+				await self._monitor()
+			except CancelledError:
+				raise
+			except Exception:
+				log.exception("Unhandled exception in the consul monitor (THIS IS A BUG, PLEASE REPORT);"
+				              "restarting asyncio monitor ...")
+			else:
+				break
+
 	async def _monitor(self) -> None:
 		self._local.state = {}
-		self._local.consul = self._consul(self._config['host'], self._config['port'],
-			consistency=self._config['consistency'])
+		self._local.digests = {}
+		self._local.indexes = {}
+		self._local.save = None  # type: Optional[asyncio.Future]
+		self._local.save_pending = False
+
+		fetch_limit = self._config.get('max-fetches', 0)
+		self._local.fetch_limit = asyncio.Semaphore(fetch_limit) if fetch_limit > 0 else None
 
 		# Services that we pay attention to
 		services = self.services_needed()
 
+		agents = [self._parse_agent(agent) for agent in self._config.get('agents') or ()]
+		self._local.consul = self._consul(self._config['host'], self._config['port'],
+			consistency=self._config['consistency'], limit=self._connection_limit(services),
+			agent_cache=self._config.get('agent-cache', False), max_age=self._config.get('max-age'),
+			compress=self._config.get('compress', True), agents=agents)
+
+		check_interval = self._config.get('agent-check-interval', 0)
+		checks = ensure_future(self._check_agents(check_interval)) if agents and check_interval > 0 else None
+
+		# Previously saved state is used until consul answers, queries are resumed from its indexes
+		warm_state = self._load_state(services)
+		if warm_state:
+			log.info("Using saved state of %d services", len(warm_state))
+			self.change_detected(self._apply_state(warm_state))
+
+		try:
+			if self._config['monitor'] == 'service':
+				await self._monitor_services(services)
+			else:
+				await self._monitor_data_centers(services)
+		finally:
+			if checks is not None:
+				checks.cancel()
+
+		self._local.consul.close()
+
+	def _connection_limit(self, services: List[str]) -> int:
+		"""
+		Returns maximum number of connections to consul; every blocking query holds its connection for up to the whole
+		wait, so they can't be queued behind each other (non-blocking queries are limited by `max-fetches`)
+		:param services: list of services to watch
+		:return: number of connections, 0 means unlimited
+		"""
+		if self._config['monitor'] == 'service':
+			# one blocking query per service
+			return 0
+
+		# one blocking query per data center, the rest is left for refetching of services
+		return len(self._get_monitor_services(services)) + 10
+
+	async def _check_agents(self, interval: float) -> None:
+		"""
+		Periodically checks consul agents, so queries are moved away from a failed agent (and back once it recovers)
+		:param interval: time between checks, in seconds
+		"""
+		while True:
+			await asyncio.sleep(interval)
+			# noinspection PyBroadException
+			try:
+				if await self._local.consul.check_agents() == 0:
+					log.error("No consul agent is available")
+			except Exception:
+				log.exception("Failed to check consul agents")
+
+	@staticmethod
+	def _parse_agent(agent: str) -> Tuple[str, str]:
+		"""
+		Parses address of an agent in form of host[:port]
+		:return: tuple containing host and port
+		"""
+		host, _, port = agent.rpartition(':')
+		if not host or not port.isdigit():
+			return agent, '8500'
+
+		return host, port
+
+	async def _monitor_data_centers(self, services: List[str]) -> None:
+		"""
+		Watches one service per data center, a change of its index triggers refetch of all services
+		:param services: list of services to watch
+		"""
+
 		# Services which we use for monitoring (each supposed to have their own index)
 		monitored_services = self._get_monitor_services(services)
 
@@ -93,16 +214,20 @@ class ConsulListener(AbsSource):
 
 		log.debug("Using following services for monitoring indices: %s", ", ".join(monitored_services))
 
+		# Saved indexes can only be used when saved state covers all services (others need to be fetched)
+		index = self._local.indexes  # type: Dict[str, str]
+		if not all(service in self._local.state for service in services):
+			index.clear()
+
 		# Schedule services
-		pending = {ensure_future(self._health_service(service)) for service in monitored_services}
-		index = {}  # type: Dict[str, str]
+		pending = {ensure_future(self._health_service(service, index.get(service))) for service in monitored_services}
 		while True:
 			done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
 
 			changed = False
 			for task in done:
 				try:
-					i, service, _ = task.result()
+					i, service, _, _ = task.result()
 				except CancelledError:
 					log.info("Got cancellation request; exiting")
 					raise
@@ -118,19 +243,86 @@ class ConsulListener(AbsSource):
 			if changed:
 				log.debug("Calculating differences in consul changes %s", [(name, value) for name, value in index.items()])
 				changes = await self._calculate_changes(services)
+				if changes:
+					self.change_detected(changes)
+				else:
+					log.debug("Responses didn't change")
+			else:
+				log.debug("No changes detected")
+
+	async def _monitor_services(self, services: List[str]) -> None:
+		"""
+		Watches every service with its own blocking query, only services whose index moved are diffed
+		:param services: list of services to watch
+		"""
+
+		if len(services) == 0:
+			log.error("No services to monitor")
+			return
+
+		log.debug("Using per service indices for: %s", ", ".join(services))
+
+		# Obtain complete state first (unless it was saved), so the sink doesn't see partial data
+		index = self._local.indexes  # type: Dict[str, str]
+		cold = [service for service in services if service not in index]
+		if cold:
+			new_state = {}  # type: T_STATE_UPDATE
+			for i, service, digest, nodes in await asyncio.gather(*[self._health_service(service) for service in cold]):
+				index[service] = i
+				new_state[service] = digest, nodes
+
+			self.change_detected(self._apply_state(new_state))
+
+		pending = {ensure_future(self._health_service(service, index[service])) for service in services}
+		while True:
+			done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+			new_state = {}
+			for task in done:
+				try:
+					i, service, digest, nodes = task.result()
+				except CancelledError:
+					log.info("Got cancellation request; exiting")
+					raise
+
+				if i == index[service]:
+					log.debug("%s - timeout; no change", service)
+				else:
+					index[service] = i
+					new_state[service] = digest, nodes
+
+				pending.add(ensure_future(self._health_service(service, i)))
+
+			changes = self._apply_state(new_state)
+			if changes:
+				log.debug("Detected changes for %s", [(name, index[name]) for name in new_state])
 				self.change_detected(changes)
 			else:
 				log.debug("No changes detected")
 
-		self._local.consul.close()
+	async def _health_service(self, service: str, index: str = None) -> Tuple[str, str, bytes, Optional[List[Node]]]:
+		"""
+		Obtains healthy nodes of the service
+		:param service: name of the service
+		:param index: index for blocking query
+		:return: tuple containing new index, service name, digest of the response and list of nodes (None when
+		         the response is identical to the one that is already applied)
+		"""
+		options = self.discovery_options(service)
 
-	@classmethod
-	# @async_ttl_cache(60)
-	async def _health_service(cls, service: str, index: str = None) -> Tuple[str, str, List[Node]]:
+		attempt = 0
 		while True:
+			query = functools.partial(self._local.consul.health.service, service, index, self._wait(), passing=True,
+				tags=tuple(options.get('tags') or ()), filter=options.get('filter'))
+
 			# noinspection PyBroadException
 			try:
-				index, response = await cls._local.consul.health.service(service, index, '5m', passing=True)
+				# requests which return right away are limited, blocking ones mostly wait for changes
+				if self._local.fetch_limit is None or index not in (None, '0'):
+					index, response = await query()
+				else:
+					async with self._local.fetch_limit:
+						index, response = await query()
 			except (ConnectionError, HTTPResponseError) as e:
 				log.error('Received an error when querying consul: %r', e)
 			except Exception:
@@ -138,79 +330,262 @@ class ConsulListener(AbsSource):
 			else:
 				break
 
-			log.info("%s: Sleeping for 1 minute before retrying" % service)
-			await asyncio.sleep(60)
+			delay = self._backoff(attempt)
+			attempt += 1
+
+			log.info("%s: Sleeping for %.1f seconds before retrying", service, delay)
+			await asyncio.sleep(delay)
 
-		nodes = []
 		# noinspection PyUnboundLocalVariable
-		for node in response:
-			attrs, tags = hashabledict(), []
+		if response.cache_hit is not None:
+			self._check_cache_age(service, response)
+
+		if response.digest == self._local.digests.get(service):
+			return index, service, response.digest, None
+
+		nodes = []
+		for address, port, node_name, service_tags in response.project(self._project_entry):
+			attrs, tags = self._parse_tags(service_tags)
+
+			nodes.append(Node.create(address, port, node_name, attrs, tags))
+
+		return index, service, response.digest, nodes
+
+	@staticmethod
+	def _project_entry(entry: Dict[str, Any]) -> Tuple[str, Any, str, Tuple[str, ...]]:
+		"""
+		Extracts fields used by winkle from a health entry (checks and metadata are dropped)
+		:return: tuple containing address, port, node name and tags of the service
+		"""
+		service = entry['Service']
 
-			if node['Service']['Tags']:
-				for tag in node['Service']['Tags']:
-					if '=' in tag:
-						key, value = tag.split('=')
-						attrs[key] = value
-					else:
-						tags.append(tag)
+		return service['Address'], service['Port'], entry['Node']['Node'].split('.')[0], \
+			tuple(service['Tags'] or ())
 
-			node_name = '%s' % node['Node']['Node'].split('.')[0]
+	def _wait(self) -> str:
+		"""
+		Returns how long a blocking query should wait; the time is randomly shortened by up to `wait-jitter` (fraction
+		of the time), so queries of many instances don't return at the same moment
+		"""
+		wait = self._config.get('wait', 300) * (1 - self._config.get('wait-jitter', 0) * random.random())
+
+		return '%ds' % max(1, round(wait))
+
+	def _backoff(self, attempt: int) -> float:
+		"""
+		Returns how long to wait before retrying a failed query; the upper bound doubles with every attempt (up to
+		`retry-max`) and the delay is picked randomly, so instances don't retry in lockstep
+		:param attempt: number of failed attempts before the last one
+		"""
+		low, high = self._config.get('retry-min', 1), self._config.get('retry-max', 60)
+
+		return random.uniform(low, min(high, low * 2 ** min(attempt + 1, 32)))
+
+	def _check_cache_age(self, service: str, response: Payload) -> None:
+		"""
+		Accounts a response which went through the agent cache and warns when it is older than allowed
+		"""
+		if response.cache_hit:
+			self._agent_cache_hits += 1
+		else:
+			self._agent_cache_misses += 1
 
-			nodes.append(Node(node['Service']['Address'], node['Service']['Port'], node_name, attrs, frozenset(tags)))
+		max_age = self._config.get('max-age')
+		if max_age is not None and response.age is not None and response.age > max_age:
+			log.warning("%s: response from the agent cache is %d seconds old (more than %d)", service, response.age,
+				max_age)
 
-		return index, service, nodes
+	@staticmethod
+	@functools.lru_cache(maxsize=8192)
+	def _parse_tags(service_tags: Tuple[str, ...]) -> Tuple[hashabledict, FrozenSet[str]]:
+		"""
+		Splits tags of a service into attributes (tags in form of key=value) and plain tags. Nodes of a service
+		tend to have identical tags, so parsed results are memoized.
+		:param service_tags: tags as returned by consul
+		:return: tuple containing attributes and tags
+		"""
+		attrs, tags = {}, []
 
-	@classmethod
-	async def _get_new_state(cls, services: List[str]) -> Dict[str, List[Node]]:
+		for tag in service_tags:
+			if '=' in tag:
+				key, value = tag.split('=')
+				attrs[key] = value
+			else:
+				tags.append(tag)
+
+		return intern_attrs(hashabledict(attrs)), intern_tags(frozenset(tags))
+
+	async def _get_new_state(self, services: List[str]) -> T_STATE_UPDATE:
 		# schedule tasks
-		futures = [asyncio.ensure_future(cls._health_service(service)) for service in services]
+		futures = [asyncio.ensure_future(self._health_service(service)) for service in services]
 
 		# process results
 		results = {}
 		for future in asyncio.as_completed(futures):
-			_, service, data = await future
-			results[service] = data
+			_, service, digest, data = await future
+			results[service] = digest, data
 
 		return results
 
 	async def _calculate_changes(self, services: List[str]) -> T_CHANGES:
-		old_state = self._local.state
 		new_state = await self._get_new_state(services)
 
+		return self._apply_state(new_state)
+
+	def _apply_state(self, new_state: T_STATE_UPDATE) -> T_CHANGES:
+		"""
+		Calculates differences for services present in the new state and stores them as the current state
+		:param new_state: fresh list of nodes for services that need to be compared
+		:return: changes for services from the new state (services with unchanged responses are skipped)
+		"""
+		old_state = self._local.state
+
 		# Calculate differences
 		changes = {}
-		for service in services:
+		for service, (digest, nodes) in new_state.items():
+			if nodes is None:
+				log.debug("%s - response didn't change; skipping", service)
+				self._suppressed_updates += 1
+				continue
+
 			canonical_service = self._hooks['source2service']('consul', service)
+			changes[canonical_service] = service_changes(old_state.get(service, ()), nodes)
+
+			old_state[service] = tuple(nodes)
+			self._local.digests[service] = digest
+
+		if changes:
+			self._publish()
+			self._schedule_save()
+
+		return changes
 
-			# get nodes for given service
-			old_nodes = set(old_state.get(service, []))
-			new_nodes = set(new_state.get(service, []))
+	def _publish(self) -> None:
+		"""
+		Publishes current state as a new snapshot
+		"""
+		self._snapshot = Snapshot(self._snapshot.version + 1, dict(self._local.state))
+		if log.isEnabledFor(logging.DEBUG):
+			log.debug("Published snapshot version %d (%s)", self._snapshot.version,
+				', '.join('%s: %d' % item for item in self.stats.items()))
 
-			# list of nodes comparable by address/port
-			old_addrs = set(map(NodeAddr, old_nodes))
-			new_addrs = set(map(NodeAddr, new_nodes))
+	def _load_state(self, services: List[str]) -> T_STATE_UPDATE:
+		"""
+		Loads state saved by a previous run
+		:param services: services that are needed (others are ignored)
+		:return: saved state of the services; their indexes are restored as well
+		"""
+		if self._state_file is None or not self._state_file.exists():
+			return {}
 
-			added = frozenset(x.node for x in new_addrs - old_addrs)
-			removed = frozenset(x.node for x in old_addrs - new_addrs)
-			updated = frozenset(new_nodes - old_nodes - added)
+		try:
+			with self._state_file.open() as f:
+				data = json.load(f)
 
-			changes[canonical_service] = Changes(added, removed, updated)
+			if data.get('version') != STATE_VERSION:
+				log.warning("%s has unsupported version %r; ignoring it", self._state_file, data.get('version'))
+				return {}
 
-		self._local.state = new_state
+			state = {}  # type: T_STATE_UPDATE
+			for service in services:
+				saved = data['services'].get(service)
+				if saved is None:
+					continue
 
-		return changes
+				nodes = [Node.create(address, port, name, attrs, tags) for address, port, name, attrs, tags in
+					saved['nodes']]
+				state[service] = bytes.fromhex(saved['digest']), nodes
+
+				if service in data['indexes']:
+					self._local.indexes[service] = data['indexes'][service]
+		except (OSError, ValueError, KeyError, TypeError) as e:
+			log.error("Unable to load state from %s: %r", self._state_file, e)
+			self._local.indexes.clear()
+			return {}
+
+		return state
+
+	def _schedule_save(self) -> None:
+		"""
+		Schedules saving of current state and indexes, so they can be used right after restart; changes are written
+		together at most once per `state-interval`
+		"""
+		if self._state_file is None:
+			return
+
+		self._local.save_pending = True
+		if self._local.save is None:
+			self._local.save = ensure_future(self._save_later())
+
+	async def _save_later(self) -> None:
+		"""
+		Writes the state once the interval passes and again when it changed during the write (one write at a time)
+		"""
+		try:
+			while self._local.save_pending:
+				await asyncio.sleep(self._config.get('state-interval', 5))
+				self._local.save_pending = False
+
+				# nodes are immutable and replaced as a whole, so shallow copies are enough for the worker thread
+				await asyncio.get_event_loop().run_in_executor(None, self._save_state, dict(self._local.state),
+					dict(self._local.indexes), dict(self._local.digests))
+		finally:
+			self._local.save = None
+
+	def _save_state(self, state: Dict[str, Tuple[Node, ...]], indexes: Dict[str, str], digests: Dict[str, bytes]) \
+			-> None:
+		"""
+		Saves the state (called in a worker thread); the file is replaced atomically
+		"""
+		data = {
+			'version': STATE_VERSION,
+			'indexes': indexes,
+			'services': {service: {
+				'digest': digests[service].hex(),
+				'nodes': [(node.address, node.port, node.name, node.attrs, sorted(node.tags)) for node in nodes]
+			} for service, nodes in state.items()}
+		}
+
+		tmp = self._state_file.with_name('.%s.tmp' % self._state_file.name)
+		try:
+			with tmp.open('w') as f:
+				json.dump(data, f, separators=(',', ':'))
+
+			os.replace(str(tmp), str(self._state_file))
+		except OSError as e:
+			log.error("Unable to save state to %s: %r", self._state_file, e)
+
+	@property
+	def stats(self) -> Dict[str, int]:
+		"""
+		Statistics of the listener
+		"""
+		tag_cache = self._parse_tags.cache_info()
+
+		return {
+			'suppressed-updates': self._suppressed_updates,
+			'agent-cache-hits': self._agent_cache_hits,
+			'agent-cache-misses': self._agent_cache_misses,
+			'tag-cache-hits': tag_cache.hits,
+			'tag-cache-misses': tag_cache.misses,
+			'tag-cache-size': tag_cache.currsize
+		}
 
 	# thread safe interface
-	def service_nodes(self, service: str, timeout: int = 5) -> List[Node]:
+	@property
+	def snapshot(self) -> Snapshot:
+		"""
+		Latest published state of services (threadsafe)
+		"""
+		return self._snapshot
+
+	def service_nodes(self, service: str, snapshot: Optional[Snapshot] = None) -> Tuple[Node, ...]:
 		"""
 		Obtains list of available nodes for given service (threadsafe)
 		:param service: name of the service (consul)
-		:param timeout: how long to wait for response
+		:param snapshot: snapshot to look into, the latest one is used when not provided
 		"""
-		async def get_nodes_for_service():
-			return self._local.state[service]
-
-		with self.__control_lock:
-			future = asyncio.run_coroutine_threadsafe(get_nodes_for_service(), self._loop)
+		if snapshot is None:
+			snapshot = self._snapshot
 
-		return future.result(timeout)
+		return snapshot.services.get(service, ())
@@ -7,13 +7,27 @@ default_config = {
 		'group': 'winkle',
 		'log-file': '/var/log/winkle/winkle.log',
 		'pid-file': '/var/run/winkle/winkle.pid',
-		'foreground': False
+		'foreground': False,
+		'single-loop': False  # run sources in the main event loop instead of their own threads
 	},
 	'sources': {
 		'consul': {
 			'host': '127.0.0.1',
 			'port': 8500,
-			'consistency': 'stale'
+			'agents': [],              # other agents (host:port) used when the ones above are unavailable
+			'agent-check-interval': 5, # how often agents are checked, queries are moved away from failed ones
+			'consistency': 'stale',
+			'monitor': 'data-center',  # 'data-center' (one index per data center) or 'service' (index per service)
+			'state-file': None,        # last known state of services, used right after restart
+			'state-interval': 5,       # minimum number of seconds between writes of the state file
+			'agent-cache': False,      # answer queries from the cache of the local agent
+			'max-age': None,           # maximum age of responses from the agent cache, in seconds
+			'compress': True,          # request gzip compressed responses
+			'wait': 300,               # maximum time a blocking query waits for changes, in seconds (at most 600)
+			'wait-jitter': 0.1,        # the wait is randomly shortened by up to this fraction
+			'retry-min': 1,            # failed queries are retried after a random delay which grows exponentially
+			'retry-max': 60,           # from retry-min up to retry-max seconds
+			'max-fetches': 0           # maximum of concurrent non-blocking queries (0 = unlimited)
 		}
 	},
 	'sinks': {
@@ -25,8 +39,12 @@ default_config = {
 				'reload': 'sudo service haproxy reload',
 				'pid-file': '/var/run/haproxy.pid',
 				'state-file': '/var/run/winkle/haproxy.state',
+				'state-dir': None,  # state file per backend; needs server-state-base and load-server-state-from-file local
 				'socket': '/var/lib/haproxy/haproxy.sock',
-				'check-config': '/usr/sbin/haproxy -c -f {config}'
+				'persistent-socket': False, # keep connection to the socket open between commands
+				'master-socket': None,      # master CLI socket (-S) used for reloads in master-worker mode
+				'check-config': '/usr/sbin/haproxy -c -f {config}',
+				'command-timeout': 60  # seconds
 			},
 			'global': [
 				'stats socket /var/lib/haproxy/haproxy.sock user winkle group winkle mode 660 level admin',
@@ -40,6 +58,11 @@ default_config = {
 				'load-server-state-from-file global'
 			],
 			'services': [],
+			'slots': 0,         # spare servers per backend, used to add nodes without reloading haproxy
+			'quiet-period': 0,  # seconds without changes to wait for before updating haproxy
+			'max-delay': 0,     # maximum number of seconds a change can wait (0 = until changes stop)
+			'max-reloads': 0,   # reloads allowed within the reload window (0 = unlimited), others are deferred
+			'reload-window': 60,
 			'extra': []
 		},
 		'configs': []
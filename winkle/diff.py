@@ -0,0 +1,79 @@
+from typing import Iterable, Tuple
+
+from .types import Changes, Node, T_CHANGES
+
+def node_key(node: Node) -> Tuple[str, str]:
+	"""
+	Key identifying a node in haproxy (address and port)
+	"""
+	return node[0], node[1]
+
+def service_changes(old_nodes: Iterable[Node], new_nodes: Iterable[Node]) -> Changes:
+	"""
+	Calculates changes between two lists of nodes of a service; nodes are matched by their address and port
+	:param old_nodes: nodes that are currently known
+	:param new_nodes: nodes that were just received
+	:return: added, removed and updated nodes
+	"""
+	old = {(node[0], node[1]): node for node in old_nodes}
+	new = {(node[0], node[1]): node for node in new_nodes}
+
+	added, updated = [], []
+	for key, node in new.items():
+		previous = old.pop(key, None)
+
+		if previous is None:
+			added.append(node)
+		elif previous != node:
+			updated.append(node)
+
+	# whatever is left wasn't matched by any new node
+	return Changes(frozenset(added), frozenset(old.values()), frozenset(updated))
+
+def merge_changes(first: Changes, second: Changes) -> Changes:
+	"""
+	Combines two consecutive changes of a service into one, so applying the result is equivalent to applying both
+	(for example a node that was added and then removed doesn't appear at all)
+	:param first: older changes
+	:param second: newer changes
+	:return: merged changes
+	"""
+	added = {node_key(node): node for node in first.added}
+	removed = {node_key(node): node for node in first.removed}
+	updated = {node_key(node): node for node in first.updated}
+
+	for node in second.removed:
+		key = node_key(node)
+		if added.pop(key, None) is None:
+			updated.pop(key, None)
+			removed[key] = node
+
+	for node in second.added:
+		key = node_key(node)
+		previous = removed.pop(key, None)
+
+		if previous is None:
+			added[key] = node
+		elif previous != node:
+			updated[key] = node
+
+	for node in second.updated:
+		key = node_key(node)
+		if key in added:
+			added[key] = node
+		else:
+			updated[key] = node
+
+	return Changes(frozenset(added.values()), frozenset(removed.values()), frozenset(updated.values()))
+
+def merge_service_changes(pending: T_CHANGES, changes: T_CHANGES) -> None:
+	"""
+	Merges changes of services into pending changes (in place)
+	:param pending: changes that weren't applied yet
+	:param changes: newer changes
+	"""
+	for service, change in changes.items():
+		if service in pending:
+			pending[service] = merge_changes(pending[service], change)
+		else:
+			pending[service] = change
@@ -1,17 +1,23 @@
+import asyncio
 import logging
+import time
 from collections import defaultdict, OrderedDict, ChainMap
 from io import StringIO
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Mapping, Tuple, Union
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Set, Tuple, Union
 
 from .abstract import AbsSink, T_SERVICES
+from .diff import node_key
 from .errors import ConfigError, ConstraintFailedError
-from .haproxy_comm import HAProxyComm
-from .types import T_CHANGES, Node
+from .haproxy_comm import HAProxyComm, T_SERVERS_STATE
+from .haproxy_master import HAProxyMaster
+from .reload_budget import ReloadBudget
+from .types import T_CHANGES, Node, Snapshot
 from .utils import node_random_sort_key, node_server_id
 from .service_updater import ServiceUpdater
 
 T_SERVICES_CONFIG = Dict[str, Dict[str, Any]]
+T_SNAPSHOTS = Mapping[str, Snapshot]
 
 log = logging.getLogger(__name__)
 
@@ -26,6 +32,14 @@ STATS_CONFIG = [
 	'monitor-uri /alive'
 ]
 
+# Spare servers (slots) are rendered disabled with a placeholder address, nodes are assigned to them at runtime
+SLOT_PREFIX = 'winkle-slot-'
+SLOT_ADDRESS = '0.0.0.0'
+SLOT_PORT = '1'
+
+# haproxy expects signed 32 bit integer > 0
+MAX_SERVER_ID = 2 ** 31 - 1
+
 
 class HAProxy(AbsSink):
 	_sorting_key = node_random_sort_key
@@ -38,8 +52,20 @@ class HAProxy(AbsSink):
 		self._service_config = services
 		self._state_file = Path(self._config['service']['state-file'])
 
+		# directory with state file per backend (server-state-base with load-server-state-from-file local)
+		state_dir = self._config['service'].get('state-dir')
+		self._state_dir = Path(state_dir) if state_dir else None  # type: Optional[Path]
+		# backends whose files were written to the state directory (it can be shared with other files)
+		self._state_backends = set()  # type: Set[str]
+
 		self._service_updater = ServiceUpdater(self._config['service'])
-		self._comm = HAProxyComm(self._config['service']['socket'])
+		self._comm = HAProxyComm(self._config['service']['socket'],
+			persistent=self._config['service'].get('persistent-socket', False))
+
+		# reloads are done through the master CLI when haproxy runs in master-worker mode
+		master_socket = self._config['service'].get('master-socket')
+		self._master = HAProxyMaster(master_socket, self._config['service'].get('command-timeout', 60)) \
+			if master_socket else None  # type: Optional[HAProxyMaster]
 
 		# dictionary in form of canonical service name -> dict containing options
 		self._services = OrderedDict()                # type: T_SERVICES_CONFIG
@@ -47,15 +73,41 @@ class HAProxy(AbsSink):
 		# dictionary in form of source -> internal list of services (for cached lookups)
 		self._monitored_services = defaultdict(list)  # type: T_SERVICES
 
+		# snapshot versions (source -> version) used for the most recent configuration
+		self._rendered_versions = {}  # type: Dict[str, int]
+
+		self._reload_budget = ReloadBudget(self._config.get('max-reloads', 0), self._config.get('reload-window', 60))
+
+		# configuration was installed, but its reload was deferred because of the reload budget
+		self._reload_pending = False
+		self._deferred_updates = 0
+		self._reload_handle = None  # type: Optional[asyncio.Handle]
+
+		# serializes updates, they could interleave while waiting for commands (created in the loop)
+		self._update_lock = None  # type: Optional[asyncio.Lock]
+
+		# rendered listen sections in form of canonical service name -> (nodes of source services, nodes, section)
+		self._sections = {}  # type: Dict[str, Tuple[Optional[Tuple[Tuple[Node, ...], ...]], Tuple[Node, ...], str]]
+
+		# sort keys and server ids of nodes in form of canonical service name -> (address, port) -> (key, id)
+		self._node_keys = {}  # type: Dict[str, Dict[Tuple[str, str], Tuple[Any, int]]]
+
 		self._setup()
 
 	def _setup(self) -> None:
+		if self._master is not None and not any(line.startswith('stats socket') and 'expose-fd listeners' in line
+				for line in self._config['global']):
+			log.warning("Stats socket doesn't have 'expose-fd listeners'; connections might be refused during reloads")
+
 		# Generate list of canonical services with configuration
 		for service_name in self._config['services']:
 			defaults = {
 				'rack-aware': False,
 				'minimum': 0,
-				'data-center': None
+				'data-center': None,
+				'slots': self._config.get('slots', 0),
+				'quiet-period': self._config.get('quiet-period', 0),
+				'max-delay': self._config.get('max-delay', 0)
 			}
 
 			if isinstance(service_name, dict):
@@ -75,54 +127,166 @@ class HAProxy(AbsSink):
 
 		self._initialized = True
 
-	def _is_safe_to_update(self):
+	def update_delays(self, service: str) -> Tuple[float, float]:
+		"""
+		Returns how long to wait for more changes of a service before updating haproxy
+		:param service: canonical name of the service
+		:return: quiet period (minimum time without changes) and maximum time a change can be held, in seconds
+		"""
+		config = self._services.get(service, {
+			'quiet-period': self._config.get('quiet-period', 0),
+			'max-delay': self._config.get('max-delay', 0)
+		})
+
+		return float(config['quiet-period']), float(config['max-delay'])
+
+	def _is_safe_to_update(self, snapshots: Optional[T_SNAPSHOTS] = None):
 		for service, config in self._services.items():
-			nodes = self.service_nodes(service, config.get('data-center'))
+			nodes = self.service_nodes(service, config.get('data-center'), snapshots)
 			if len(nodes) < config['minimum']:
 				raise ConstraintFailedError("%s has less than %d nodes (%r)" % (service, config['minimum'], nodes))
 
-	def _generate_config(self) -> bytes:
+	def _generate_config(self, snapshots: Optional[T_SNAPSHOTS] = None) -> bytes:
 		assert self._initialized
 
-		# noinspection PyShadowingBuiltins
-		def format(lines, level=1):
-			return map(lambda x: '%s%s\n' % ('\t' * level, x), lines)
-
 		cnf = StringIO()
 
 		cnf.write("global\n")
-		cnf.writelines(format(self._config['global']))
+		cnf.writelines(self._format(self._config['global']))
 
 		cnf.write("\ndefaults\n")
-		cnf.writelines(format(self._config['defaults']))
+		cnf.writelines(self._format(self._config['defaults']))
 
 		cnf.write("\nfrontend stats\n")
-		cnf.writelines(format(STATS_CONFIG))
+		cnf.writelines(self._format(STATS_CONFIG))
 
+		rendered = 0
 		for service, config in self._services.items():
-			service_config = self._service_config[service]['haproxy']
-
-			cnf.write("\nlisten %s\n" % service)
-			cnf.writelines(format(service_config['options']))
-			cnf.write("\n")
+			# sections are only rendered again when their nodes change; unchanged services are recognized by identity
+			# of their nodes in snapshots, nodes are only collected and compared for services which were updated
+			sources = self._source_nodes(service, config.get('data-center'), snapshots)
+			cached = self._sections.get(service)
+			if cached is not None and sources is not None and self._same_sources(cached[0], sources):
+				section = cached[2]
+			else:
+				nodes = tuple(self.service_nodes(service, config.get('data-center'), snapshots))
+				if cached is not None and cached[1] == nodes:
+					section = cached[2]
+				else:
+					section = self._render_section(service, config, nodes)
+					rendered += 1
 
-			sorted_nodes = sorted(self.service_nodes(service, config.get('data-center')),
-					key=self.__class__._sorting_key)
+				self._sections[service] = sources, nodes, section
 
-			nodes = []
-			for node, weight in self._calculate_weights(sorted_nodes, config['rack-aware']):
-				nodes.append('server %s %s:%s id %d %s%s' % (node.name, node.address, node.port,
-					self.__class__._server_id(node), service_config['server_options'],
-					' weight %s' % weight))
+			cnf.write(section)
 
-			cnf.writelines(format(nodes))
+		log.debug("Rendered %d of %d sections", rendered, len(self._services))
 
 		if len(self._config['extra']) > 0:
 			cnf.write("\n# Extra configuration added (you should normally avoid this setting)\n")
-			cnf.writelines(format(self._config['extra'], level=0))
+			cnf.writelines(self._format(self._config['extra'], level=0))
 
 		return cnf.getvalue().encode()
 
+	def _source_nodes(self, service: str, data_center: Optional[str], snapshots: Optional[T_SNAPSHOTS]) \
+			-> Optional[Tuple[Tuple[Node, ...], ...]]:
+		"""
+		Returns nodes of source services making up the service, as they are stored in the snapshot; sources replace
+		them only when they change
+		:return: tuple of nodes of every source service, None when the snapshot isn't available
+		"""
+		if not snapshots:
+			return None
+
+		source, services = self.service2sources(service, data_center)
+		snapshot = snapshots.get(source)
+		if snapshot is None:
+			return None
+
+		return tuple(snapshot.services.get(name, ()) for name in services)
+
+	@staticmethod
+	def _same_sources(cached: Optional[Tuple[Tuple[Node, ...], ...]], sources: Tuple[Tuple[Node, ...], ...]) -> bool:
+		return cached is not None and len(cached) == len(sources) and \
+			all(first is second for first, second in zip(cached, sources))
+
+	def _render_section(self, service: str, config: Mapping[str, Any], nodes: Iterable[Node]) -> str:
+		"""
+		Renders listen section of a service
+		:param service: canonical name of the service
+		:param config: options of the service
+		:param nodes: nodes of the service
+		"""
+		service_config = self._service_config[service]['haproxy']
+
+		cnf = StringIO()
+		cnf.write("\nlisten %s\n" % service)
+		cnf.writelines(self._format(service_config['options']))
+		cnf.write("\n")
+
+		keys = self._memoized_keys(service, nodes)
+		sorted_nodes = sorted(nodes, key=(lambda node: keys[node_key(node)][0])
+			if self.__class__._sorting_key else None)
+
+		servers = []
+		for node, weight in self._calculate_weights(sorted_nodes, config['rack-aware']):
+			servers.append('server %s %s:%s id %d %s%s' % (node.name, node.address, node.port,
+				keys[node_key(node)][1], service_config['server_options'],
+				' weight %s' % weight))
+
+		for slot in range(1, config['slots'] + 1):
+			servers.append('server %s%d %s:%s disabled %s weight 0' % (SLOT_PREFIX, slot, SLOT_ADDRESS, SLOT_PORT,
+				service_config['server_options']))
+
+		cnf.writelines(self._format(servers))
+
+		return cnf.getvalue()
+
+	def _memoized_keys(self, service: str, nodes: Iterable[Node]) -> Dict[Tuple[str, str], Tuple[Any, int]]:
+		"""
+		Returns sort keys and server ids of nodes of a service. They are computed only for nodes that weren't present
+		the last time, and server ids colliding within the service are replaced with the next free ones.
+		:param service: canonical name of the service
+		:param nodes: current nodes of the service
+		:return: dictionary in form of (address, port) -> (sort key, server id)
+		"""
+		sorting_key, server_id = self.__class__._sorting_key, self.__class__._server_id
+		previous = self._node_keys.get(service, {})
+
+		# nodes which disappeared are dropped
+		keys, new = {}, []
+		for node in nodes:
+			key = node_key(node)
+			if key in previous:
+				keys[key] = previous[key]
+			else:
+				new.append(node)
+
+		used = {value[1] for value in keys.values()}
+
+		# sorted, so ids of colliding nodes don't depend on order of the nodes
+		for node in sorted(new, key=node_key):
+			key = node_key(node)
+			if key in keys:
+				continue
+
+			sid = server_id(node)
+			while sid in used:
+				log.warning("Server id %d of %s (%s:%s) collides with another server of %s; trying %d", sid, node.name,
+					node.address, node.port, service, sid % MAX_SERVER_ID + 1)
+				sid = sid % MAX_SERVER_ID + 1
+
+			used.add(sid)
+			keys[key] = (sorting_key(node) if sorting_key else None), sid
+
+		self._node_keys[service] = keys
+
+		return keys
+
+	@staticmethod
+	def _format(lines: Iterable[str], level: int = 1) -> Iterable[str]:
+		return map(lambda x: '%s%s\n' % ('\t' * level, x), lines)
+
 	def _calculate_weights(self, nodes: Iterable[Node], rack_aware: bool) -> List[Tuple[Node, int]]:
 		def node_weight(node: Node) -> Tuple[bool, Union[int, float]]:
 			weight = node.attrs.get('weight')
@@ -135,11 +299,11 @@ class HAProxy(AbsSink):
 
 			return False, int(weight)
 
+		weights = [node_weight(node) for node in nodes]
+
 		# Sum all weights
 		sum_weight, sum_weight_pct = 0, 0.0
-		for node in nodes:
-			percent, weight = node_weight(node)
-
+		for percent, weight in weights:
 			if percent:
 				sum_weight_pct += weight
 			else:
@@ -158,9 +322,7 @@ class HAProxy(AbsSink):
 
 		# Calculate weights
 		result = []
-		for node in nodes:
-			percent, weight = node_weight(node)
-
+		for node, (percent, weight) in zip(nodes, weights):
 			if percent:
 				weight = round(weight_per_pct * weight)
 				if weight < 1:
@@ -171,6 +333,44 @@ class HAProxy(AbsSink):
 
 		return result
 
+	def _node_weights(self, service: str, snapshots: Optional[T_SNAPSHOTS] = None) -> List[Tuple[Node, int]]:
+		"""
+		Calculates weights of all nodes of a service
+		"""
+		config = self._services[service]
+		nodes = self.service_nodes(service, config.get('data-center'), snapshots)
+
+		return self._calculate_weights(nodes, config['rack-aware'])
+
+	@staticmethod
+	def _slots(state: T_SERVERS_STATE) -> Tuple[Dict[Tuple[str, str], str], List[str]]:
+		"""
+		Finds slots of a backend
+		:param state: state of servers of the backend
+		:return: slots assigned to nodes (in form of (address, port) -> slot, see `_slot_key`) and list of free slots
+		"""
+		assigned, free = {}, []
+		for name, row in state.items():
+			# haproxy older than 1.8 doesn't report ports (and can't change them)
+			if not name.startswith(SLOT_PREFIX) or 'srv_port' not in row:
+				continue
+
+			if row['srv_addr'] == SLOT_ADDRESS:
+				free.append(name)
+			else:
+				assigned[row['srv_addr'], row['srv_port']] = name
+
+		free.sort(key=lambda slot: int(slot[len(SLOT_PREFIX):]))
+
+		return assigned, free
+
+	@staticmethod
+	def _slot_key(node: Node) -> Tuple[str, str]:
+		"""
+		Key of a node in slots returned by `_slots`; haproxy reports ports as strings while consul returns integers
+		"""
+		return node.address, str(node.port)
+
 	def _same_rack(self, rack: str) -> bool:
 		assert rack is not None
 
@@ -179,67 +379,107 @@ class HAProxy(AbsSink):
 
 		return self._rack == rack
 
+	@property
+	def rendered_versions(self) -> Dict[str, int]:
+		"""
+		Versions of source snapshots (source -> version) that were used to generate the current configuration
+		"""
+		return self._rendered_versions
+
 	@property
 	def services_needed(self):
 		assert self._initialized
 
 		return self._monitored_services
 
-	def _incremental_update(self, changes: T_CHANGES) -> bool:
+	def _incremental_update(self, changes: T_CHANGES, snapshots: Optional[T_SNAPSHOTS] = None,
+			deferred: bool = False) -> bool:
 		"""
 		Decide whether service needs to be reloaded or updated, and enable/disable services as needed
 
 		logic:
 		for each backend:
-		  - if entries in updated set -> reload
+		  - for updated host
+		    - if host was renamed -> reload
 		  - for added host
 		    - if new backend -> reload
-		    - if new host is added -> reload
+		    - if new host is added -> assign it a free slot, if there's none -> reload
 		    - if host is disabled -> enable
-		  - if config reload, skip to next backend
+		  - if config reload (and it isn't deferred), skip to next backend
 		  - for removed host
+		    - if host occupies a slot -> add to released list
 		    - if host not in state -> force reload (bug?)
 		    - if host already disabled -> force reload (bug?)
 		    - add to disabled list
-		if no reload is necessary, disable nodes on the list
+		  - for every known host
+		    - if its weight differs from the calculated one -> add to weights list
+		if no reload is necessary (or it is deferred), assign slots, disable and release nodes and set weights on the
+		lists
 
 		:param changes: list of incremental changes
+		:param snapshots: snapshots of sources used to calculate weights of hosts
+		:param deferred: reload won't happen right away, so apply as much as possible at runtime
 		:return: should service be reloaded
 		"""
 
 		backends = self._comm.get_backends()
+		servers_state = self._comm.get_all_servers_state()
 
 		reload = False
-		disable = defaultdict(list)
+		enable, disable, assign, release, set_weights = [], [], [], [], []
 		for backend, change in changes.items():
 			log.debug("Changes for %s: %r", backend, change)
 
-			if len(change.updated) > 0:
-				log.debug('We have updates for %s; forcing reload', backend)
-				reload = True
-
 			if backend not in backends:
 				log.debug('%s is new; forcing reload', backend)
 				reload = True
 				continue
 
-			state = self._comm.get_servers_state(backend)
+			state = servers_state.get(backend, {})
+			assigned, free = self._slots(state)
+			node_weights = self._node_weights(backend, snapshots)
+			weights = {node_key(node): weight for node, weight in node_weights}
 
-			for server in change.added:
-				if server.name not in state:
-					log.debug('%s is new; forcing reload', server.name)
+			# Changes of attributes only affect weights, which can be set at runtime, server names can't
+			for server in change.updated:
+				if server.name not in state and self._slot_key(server) not in assigned:
+					log.debug('%s was renamed; forcing reload', server.name)
 					reload = True
+
+			for server in change.added:
+				name = server.name if server.name in state else assigned.get(self._slot_key(server))
+
+				if name is None:
+					if not free:
+						log.debug('%s is new and there are no free slots; forcing reload', server.name)
+						reload = True
+						continue
+
+					weight = weights.get(node_key(server))
+					if weight is None:
+						log.debug('%s is no longer present; forcing reload', server.name)
+						reload = True
+						continue
+
+					slot = free.pop(0)
+					log.info('assigning %s to %s/%s', server.name, backend, slot)
+					assign.append((backend, slot, server.address, server.port, weight))
 					continue
 
-				if self._comm.is_server_disabled(backend, server.name, state):
-					log.info('enabling %s/%s', backend, server.name)
-					self._comm.enable_server(backend, server.name)
+				if self._comm.is_server_disabled(backend, name, state):
+					log.info('enabling %s/%s', backend, name)
+					enable.append((backend, name))
 
 			# No need to disable if we are reloading anyway
-			if reload:
+			if reload and not deferred:
 				continue
 
 			for server in change.removed:
+				slot = assigned.get(self._slot_key(server)) if server.name not in state else None
+				if slot is not None:
+					release.append((backend, slot, SLOT_ADDRESS, SLOT_PORT))
+					continue
+
 				if server.name not in state:
 					log.error("%s/%s is being removed but haproxy doesn't recognize it; forcing reload", backend,
 						server.name)
@@ -252,66 +492,182 @@ class HAProxy(AbsSink):
 					reload = True
 					break
 
-				disable[backend].append(server.name)
+				disable.append((backend, server.name))
+
+			# Percentage weights depend on weights of all nodes of the backend, so check all of them
+			for node, weight in node_weights:
+				name = node.name if node.name in state else assigned.get(self._slot_key(node))
+				if name is None or 'srv_uweight' not in state[name]:
+					continue
+
+				if int(state[name]['srv_uweight']) != weight:
+					set_weights.append((backend, name, weight))
+
+		self._comm.enable_servers(enable)
+
+		# Slots are rendered as regular servers after reload
+		if not reload or deferred:
+			self._comm.assign_servers(assign)
+
+			for backend, server in disable:
+				log.info('disabling %s/%s', backend, server)
+			self._comm.disable_servers(disable)
 
-		if not reload:
-			for backend, servers in disable.items():
-				for server in servers:
-					log.info('disabling %s/%s', backend, server)
-					self._comm.disable_server(backend, server)
+			for backend, server, _, _ in release:
+				log.info('releasing %s/%s', backend, server)
+			self._comm.release_servers(release)
+
+			for backend, server, weight in set_weights:
+				log.info('setting weight of %s/%s to %d', backend, server, weight)
+			self._comm.set_weights(set_weights)
 
 		return reload
 
 	def _save_state(self):
 		if self._comm.has_socket():
-			log.info("Writing state file to %s", self._state_file)
-			self._comm.save_state(self._state_file)
+			# state of slots would be restored to the newly rendered (spare) ones
+			exclude = lambda server: server.startswith(SLOT_PREFIX)
+
+			if self._state_dir is not None:
+				log.info("Writing state files to %s", self._state_dir)
+				self._state_backends.update(self._comm.save_backend_states(self._state_dir, exclude=exclude))
+			else:
+				log.info("Writing state file to %s", self._state_file)
+				self._comm.save_state(self._state_file, exclude=exclude)
 
 	def _clear_state(self):
 		if self._comm.has_socket():
+			if self._state_dir is not None:
+				# missing per-backend files are ignored by haproxy
+				self._wipe_state()
+				return
+
 			log.info("Clearing state file: %s", self._state_file)
 			with self._state_file.open("w") as f:
 				f.write('1\n')
 
 	def _wipe_state(self):
 		if self._comm.has_socket():
+			if self._state_dir is not None:
+				log.info("Wiping state files in %s", self._state_dir)
+				# only files written by winkle; backends of services cover files left by a previous run
+				for backend in self._state_backends | set(self._services):
+					try:
+						(self._state_dir / backend).unlink()
+					except FileNotFoundError:
+						pass
+
+				self._state_backends.clear()
+				return
+
 			log.info("Wiping state file: %s", self._state_file)
 			if self._state_file.exists():
 				self._state_file.unlink()
 
-	def process_update(self, source: str, changes: T_CHANGES) -> None:
+	async def process_update(self, source: str, changes: T_CHANGES) -> None:
 		assert self._initialized
 
-		self._is_safe_to_update()
+		if self._update_lock is None:
+			self._update_lock = asyncio.Lock()
 
-		running = self._service_updater.is_running()
-		if self._comm.has_socket():
-			reload = self._incremental_update(changes) if running else False
-		else:
-			reload = True
+		async with self._update_lock:
+			await self._process_update(source, changes)
+
+	async def _process_update(self, source: str, changes: T_CHANGES) -> None:
+		run_blocking = self._hooks['run_blocking']
+
+		# use the same state of sources for the whole update
+		snapshots = self.snapshot()
+		versions = {name: snapshot.version for name, snapshot in snapshots.items()}
+		log.debug("Processing update from %s using snapshots %r", source, versions)
+
+		self._is_safe_to_update(snapshots)
 
 		log.debug("Generating config")
-		new_config = self._generate_config()
+		new_config = await run_blocking(self._generate_config, snapshots)
+		self._rendered_versions = versions
 
+		# new config is validated while haproxy is being updated through the socket; the validation task is let to
+		# start its process first, since run_blocking doesn't yield to the loop when it runs the task directly
+		validation = None
 		if self._service_updater.needs_update(new_config):
-			log.info("Config is different; updating")
-			self._service_updater.update_config(new_config)
+			log.info("Config is different; validating")
+			validation = asyncio.ensure_future(self._service_updater.stage_config(new_config))
+			await asyncio.sleep(0)
+
+		# when the reload has to wait, the changes are applied at runtime as much as possible
+		deferred = self._reload_budget.delay() > 0
+
+		try:
+			running = await self._service_updater.is_running()
+			if self._comm.has_socket():
+				reload = await run_blocking(self._incremental_update, changes, snapshots, deferred) \
+					if running else False
+			else:
+				reload = True
+		except Exception:
+			if validation is not None:
+				validation.cancel()
+			raise
+
+		if validation is not None:
+			await validation
+			log.info("Config is valid; updating")
+			self._service_updater.install_config()
 		else:
 			log.info("No change in config; skipping update")
 			reload = False  # if we didn't modify the file there's no point reloading
 
+		# config installed by a deferred update is still waiting for reload
+		reload = reload or self._reload_pending
+
 		if not running:
 			log.info("HAProxy is not running; starting the service")
 
 			# State file existing at this point is invalid
 			self._clear_state()
 
-			self._service_updater.start()
+			await self._service_updater.start()
+			self._comm.reset()
+			self._reload_pending, self._deferred_updates = False, 0
+		elif reload and self._reload_budget.delay() > 0:
+			delay = self._reload_budget.delay()
+			self._reload_pending = True
+			self._deferred_updates += 1
+			log.warning("Reload budget exhausted; deferring reload by %.1f seconds (%d updates waiting)", delay,
+				self._deferred_updates)
+
+			if self._reload_handle is None:
+				self._reload_handle = asyncio.get_event_loop().call_later(delay,
+					lambda: asyncio.ensure_future(self._deferred_reload()))
 		elif reload:
-			self._save_state()
+			self._reload_budget.spend()
+			if self._reload_pending:
+				log.info("Reload includes %d deferred updates", self._deferred_updates)
+
+			await run_blocking(self._save_state)
 
 			log.info("Reloading haproxy")
-			self._service_updater.reload()
+			started = time.monotonic()
+			if self._master is not None:
+				# waits until the new worker is up
+				await self._master.reload()
+			else:
+				await self._service_updater.reload()
+			log.info("Reload took %.3f seconds", time.monotonic() - started)
+			self._comm.reset()
+			self._reload_pending, self._deferred_updates = False, 0
 
 			# Remove state file after reload
 			self._clear_state()
+
+	async def _deferred_reload(self) -> None:
+		"""
+		Applies all deferred updates once the reload budget allows it
+		"""
+		self._reload_handle = None
+
+		try:
+			await self.process_update('haproxy', {})
+		except Exception:
+			log.exception("Deferred reload failed")
@@ -1,19 +1,84 @@
-import csv
 import io
+import logging
+import os
 import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable, Iterable, Iterator, Mapping, Optional, Tuple
 
 from .haproxy_comm_enums import ServerState, ServerAdmin, CheckStatus, CheckResult, CheckState
 
-csv.register_dialect('haproxy', delimiter=' ', quoting=csv.QUOTE_NONE)
+log = logging.getLogger(__name__)
 
-T_SERVERS_STATE = Dict[str, Dict[str, Any]]
+BUFFER_SIZE = 65536
+
+# HAProxy reads a request into a single buffer (tune.bufsize, 16kB by default)
+MAX_REQUEST_SIZE = 8192
+
+PROMPT = b'\n> '
+
+# number of state files written at the same time
+STATE_WRITERS = 8
+
+# informational responses of `set server addr`
+ADDRESS_CHANGED = ('IP changed', 'no need to change')
+
+# columns of `show servers state` that are converted to enums
+CONVERTERS = {
+	'srv_op_state': ServerState,
+	'srv_admin_state': ServerAdmin.flags,
+	'srv_check_status': CheckStatus,
+	'srv_check_result': CheckResult,
+	'srv_check_state': CheckState.flags,
+	'srv_agent_state': CheckState.flags
+}  # type: Dict[str, Callable[[int], Any]]
+
+class ServerStateRow:
+	"""
+	Row of `show servers state` output; values are converted only when they are accessed
+	"""
+	__slots__ = ('_columns', '_values')
+
+	def __init__(self, columns: Mapping[str, int], values: List[str]):
+		self._columns = columns
+		self._values = values
+
+	def __getitem__(self, name: str) -> Any:
+		value = self._values[self._columns[name]]
+
+		converter = CONVERTERS.get(name)
+		if converter:
+			return converter(int(value))
+
+		return value
+
+	def __contains__(self, name: str) -> bool:
+		return name in self._columns
+
+	def get(self, name: str, default: Any = None) -> Any:
+		return self[name] if name in self._columns else default
+
+	def __repr__(self):
+		return '%s(%r)' % (self.__class__.__name__, dict(zip(self._columns, self._values)))
+
+T_SERVERS_STATE = Dict[str, ServerStateRow]
 
 class HAProxyComm:
-	def __init__(self, socket_name: str):
+	def __init__(self, socket_name: str, persistent: bool = False):
+		"""
+		:param socket_name: path to the stats socket
+		:param persistent: keep the connection open between commands (uses interactive mode of the socket)
+		"""
 		self._socket = socket_name
+		self._persistent = persistent
+
+		self._connection = None  # type: Optional[socket.socket]
+		self._lock = threading.Lock()
+
+		# identity (device, inode) of the socket file the connection was opened to
+		self._socket_id = None  # type: Optional[Tuple[int, int]]
 
 	def has_socket(self):
 		return Path(self._socket).is_socket()
@@ -25,20 +90,31 @@ class HAProxyComm:
 
 	def get_servers_state(self, backend: str) -> T_SERVERS_STATE:
 		response = self._command('show servers state %s' % backend)
+		return self._parse_servers_state(response).get(backend, {})
+
+	def get_all_servers_state(self) -> Dict[str, T_SERVERS_STATE]:
+		"""
+		Obtains state of servers of all backends with a single request
+		:return: dictionary in form of backend -> server -> state
+		"""
+		return self._parse_servers_state(self._command('show servers state'))
+
+	@staticmethod
+	def _parse_servers_state(response: List[str]) -> Dict[str, T_SERVERS_STATE]:
 		assert response[0] == '1', "Unsupported version of HAProxy output"
 
-		reader = csv.DictReader(response[1:], dialect='haproxy')
-		reader.fieldnames = reader.fieldnames[1:]  # HAProxy marks fields with '#'
+		# HAProxy marks fields with '#'
+		columns = {name: i for i, name in enumerate(response[1].split(' ')[1:])}
+		be_name, srv_name = columns['be_name'], columns['srv_name']
 
-		state = {}
-		for row in reader:
-			row['srv_op_state'] = ServerState(int(row['srv_op_state']))
-			row['srv_admin_state'] = ServerAdmin.flags(int(row['srv_admin_state']))
-			row['srv_check_status'] = CheckStatus(int(row['srv_check_status']))
-			row['srv_check_result'] = CheckResult(int(row['srv_check_result']))
-			row['srv_check_state'] = CheckState.flags(int(row['srv_check_state']))
-			row['srv_agent_state'] = CheckState.flags(int(row['srv_agent_state']))
-			state[row['srv_name']] = row
+		state = {}  # type: Dict[str, T_SERVERS_STATE]
+		for line in response[2:]:
+			values = line.split(' ')
+			backend = state.get(values[be_name])
+			if backend is None:
+				backend = state[values[be_name]] = {}
+
+			backend[values[srv_name]] = ServerStateRow(columns, values)
 
 		return state
 
@@ -54,34 +130,248 @@ class HAProxyComm:
 	def disable_server(self, backend: str, server: str):
 		self._command('disable server %s/%s' % (backend, server))
 
-	def save_state(self, file: Path) -> None:
-		with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as sock, file.open('wb') as fo:
+	def enable_servers(self, servers: Iterable[Tuple[str, str]]) -> None:
+		"""
+		Enables multiple servers using as few requests as possible
+		:param servers: list of (backend, server) tuples
+		"""
+		self._log_errors(self.commands('enable server %s/%s' % server for server in servers))
+
+	def disable_servers(self, servers: Iterable[Tuple[str, str]]) -> None:
+		"""
+		Disables multiple servers using as few requests as possible
+		:param servers: list of (backend, server) tuples
+		"""
+		self._log_errors(self.commands('disable server %s/%s' % server for server in servers))
+
+	def set_weights(self, servers: Iterable[Tuple[str, str, int]]) -> None:
+		"""
+		Sets weights of multiple servers using as few requests as possible
+		:param servers: list of (backend, server, weight) tuples
+		"""
+		self._log_errors(self.commands('set weight %s/%s %d' % server for server in servers))
+
+	def assign_servers(self, servers: Iterable[Tuple[str, str, str, str, int]]) -> None:
+		"""
+		Points servers to new addresses and puts them into service
+		:param servers: list of (backend, server, address, port, weight) tuples
+		"""
+		commands = []
+		for backend, server, address, port, weight in servers:
+			commands += [
+				'set server %s/%s addr %s port %s' % (backend, server, address, port),
+				'set weight %s/%s %d' % (backend, server, weight),
+				'set server %s/%s state ready' % (backend, server)
+			]
+
+		self._log_errors(self.commands(commands), ignore=ADDRESS_CHANGED)
+
+	def release_servers(self, servers: Iterable[Tuple[str, str, str, str]]) -> None:
+		"""
+		Puts servers into maintenance and points them to a placeholder address
+		:param servers: list of (backend, server, address, port) tuples
+		"""
+		commands = []
+		for backend, server, address, port in servers:
+			commands += [
+				'set server %s/%s state maint' % (backend, server),
+				'set server %s/%s addr %s port %s' % (backend, server, address, port)
+			]
+
+		self._log_errors(self.commands(commands), ignore=ADDRESS_CHANGED)
+
+	def save_state(self, file: Path, exclude: Optional[Callable[[str], bool]] = None) -> None:
+		"""
+		Saves state of all servers in a format understood by server-state-file
+		:param file: path to the state file
+		:param exclude: predicate selecting (by name) servers whose state shouldn't be saved
+		"""
+		if exclude is not None:
+			response = self._command('show servers state')
+			srv_name = response[1].split(' ')[1:].index('srv_name')
+
+			self._write_file(file, [line for i, line in enumerate(response)
+				if i < 2 or not exclude(line.split(' ')[srv_name])])
+			return
+
+		tmp = file.with_name('.%s.tmp' % file.name)
+		with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as sock, tmp.open('wb') as fo:
 			sock.connect(self._socket)
 			sock.sendall(b'show servers state\n')
 
 			while True:
-				buff = sock.recv(1024)
+				buff = sock.recv(BUFFER_SIZE)
 				if len(buff) == 0:
 					break
 				fo.write(buff)
 
+		os.replace(str(tmp), str(file))
+
+	def save_backend_states(self, directory: Path, exclude: Optional[Callable[[str], bool]] = None) -> List[str]:
+		"""
+		Saves state of servers of every backend into its own file (named after the backend), which is the layout
+		expected by `load-server-state-from-file local`; state is obtained with a single request and files are
+		written concurrently
+		:param directory: directory with the state files (server-state-base)
+		:param exclude: predicate selecting (by name) servers whose state shouldn't be saved
+		:return: names of backends whose files were written
+		"""
+		response = self._command('show servers state')
+		columns = response[1].split(' ')[1:]
+		be_name, srv_name = columns.index('be_name'), columns.index('srv_name')
+
+		backends = {}  # type: Dict[str, List[str]]
+		for line in response[2:]:
+			values = line.split(' ')
+			if exclude is not None and exclude(values[srv_name]):
+				continue
+
+			lines = backends.get(values[be_name])
+			if lines is None:
+				lines = backends[values[be_name]] = response[:2]
+			lines.append(line)
+
+		with ThreadPoolExecutor(max_workers=STATE_WRITERS) as executor:
+			list(executor.map(lambda item: self._write_file(directory / item[0], item[1]), backends.items()))
+
+		return list(backends)
+
+	@staticmethod
+	def _write_file(file: Path, lines: List[str]) -> None:
+		"""
+		Replaces file atomically, so haproxy never reads a partially written one
+		"""
+		tmp = file.with_name('.%s.tmp' % file.name)
+		with tmp.open('w', buffering=BUFFER_SIZE) as fo:
+			fo.writelines('%s\n' % line for line in lines)
+
+		os.replace(str(tmp), str(file))
+
+	def commands(self, commands: Iterable[str]) -> List[str]:
+		"""
+		Executes multiple commands; commands are separated with ';' and sent in as few requests as possible
+		:param commands: list of commands
+		:return: combined output of the commands
+		"""
+		result = []
+		for batch in self._batches(commands):
+			result += self._command(';'.join(batch))
+
+		return result
+
+	def reset(self) -> None:
+		"""
+		Closes the persistent connection (needs to be called when haproxy is restarted or reloaded, since the
+		connection would still point to the old process)
+		"""
+		with self._lock:
+			self._disconnect()
+
 	def _command(self, command: str) -> List[str]:
+		if self._persistent:
+			with self._lock:
+				result = self._prompt_command(command)
+		else:
+			result = self._single_command(command)
+
+		# truncate empty lines at the end
+		while len(result) > 0 and result[-1] == '':
+			result = result[0:-1]
+
+		return result
+
+	def _single_command(self, command: str) -> List[str]:
 		recv = io.BytesIO()
 		with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as sock:
 			sock.connect(self._socket)
 			sock.sendall('{}\n'.format(command).encode())
 
 			while True:
-				buff = sock.recv(1024)
+				buff = sock.recv(BUFFER_SIZE)
 				if len(buff) == 0:
 					break
 
 				recv.write(buff)
 
-		result = recv.getvalue().decode().splitlines()
+		return recv.getvalue().decode().splitlines()
 
-		# truncate empty lines at the end
-		while len(result) > 0 and result[-1] == '':
-			result = result[0:-1]
+	def _prompt_command(self, command: str) -> List[str]:
+		# haproxy reloaded by someone else binds a new socket, while the connection still leads to the old process
+		if self._connection is not None and self._get_socket_id() != self._socket_id:
+			log.info("%s was replaced; reconnecting", self._socket)
+			self._disconnect()
+
+		# the connection might have been closed by haproxy (idle timeout, reload), so retry once with a new one
+		for attempt in range(2):
+			try:
+				if self._connection is None:
+					self._connect()
+
+				self._connection.sendall('{}\n'.format(command).encode())
+				return self._read_prompt().decode().splitlines()
+			except (OSError, EOFError):
+				self._disconnect()
+				if attempt > 0:
+					raise
+
+	def _get_socket_id(self) -> Optional[Tuple[int, int]]:
+		try:
+			st = os.stat(self._socket)
+		except OSError:
+			return None
+
+		return st.st_dev, st.st_ino
+
+	def _connect(self) -> None:
+		self._socket_id = self._get_socket_id()
+
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			sock.connect(self._socket)
+			sock.sendall(b'prompt\n')
+		except OSError:
+			sock.close()
+			raise
+
+		self._connection = sock
+		self._read_prompt()
+
+	def _disconnect(self) -> None:
+		if self._connection is not None:
+			self._connection.close()
+			self._connection = None
+
+	def _read_prompt(self) -> bytes:
+		"""
+		Reads response of a command in interactive mode (it is terminated by a prompt)
+		:return: response without the prompt
+		"""
+		recv = bytearray()
+		while not recv.endswith(PROMPT) and recv != PROMPT[1:]:
+			buff = self._connection.recv(BUFFER_SIZE)
+			if len(buff) == 0:
+				raise EOFError("Connection closed by haproxy")
+
+			recv += buff
+
+		return bytes(recv[:-2])
+
+	@staticmethod
+	def _batches(commands: Iterable[str]) -> Iterator[List[str]]:
+		batch, size = [], 0
+		for command in commands:
+			if batch and size + len(command) + 1 > MAX_REQUEST_SIZE:
+				yield batch
+				batch, size = [], 0
+
+			batch.append(command)
+			size += len(command) + 1
+
+		if batch:
+			yield batch
 
-		return result
\ No newline at end of file
+	@staticmethod
+	def _log_errors(response: List[str], ignore: Tuple[str, ...] = ()) -> None:
+		for line in response:
+			if line and not line.startswith(ignore):
+				log.warning("HAProxy: %s", line)
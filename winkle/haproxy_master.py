@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import time
+from typing import List, NamedTuple
+
+log = logging.getLogger(__name__)
+
+# how often to ask the master whether the new worker is up
+POLL_INTERVAL = 0.1
+
+Process = NamedTuple('Process', (
+	('pid', int),
+	('type', str),
+	('old', bool)))
+
+class ReloadError(Exception):
+	pass
+
+class HAProxyMaster:
+	"""
+	Client of the master CLI of haproxy running in master-worker mode (-W or -Ws)
+	"""
+
+	def __init__(self, socket_name: str, timeout: float = 60):
+		"""
+		:param socket_name: path to the master socket (-S option)
+		:param timeout: maximum time to wait for a new worker after reload, in seconds
+		"""
+		self._socket = socket_name
+		self._timeout = timeout
+
+	async def show_proc(self) -> List[Process]:
+		"""
+		Lists master and worker processes
+		"""
+		return self._parse_proc(await self._command('show proc'))
+
+	async def workers(self) -> List[int]:
+		"""
+		Returns pids of current (not old) workers
+		"""
+		return [process.pid for process in await self.show_proc() if process.type == 'worker' and not process.old]
+
+	async def reload(self) -> float:
+		"""
+		Reloads haproxy and waits for the new worker to be up
+		:return: time it took, in seconds
+		:raises ReloadError: when haproxy refused the new configuration or the worker didn't start in time
+		"""
+		started = time.monotonic()
+		previous = set(await self.workers())
+
+		# the master re-executes itself, so the connection is closed once the reload is initiated
+		response = await self._command('reload')
+		if any(line.startswith('Success=0') for line in response):
+			raise ReloadError("HAProxy failed to reload: %s" % ' '.join(response))
+
+		while True:
+			try:
+				workers = set(await self.workers())
+			except OSError:
+				# the master is still starting up
+				workers = previous
+
+			if workers and not workers & previous:
+				log.debug("New worker %s is up", ', '.join(map(str, sorted(workers))))
+				return time.monotonic() - started
+
+			if time.monotonic() - started > self._timeout:
+				raise ReloadError("New worker didn't start within %s seconds" % self._timeout)
+
+			await asyncio.sleep(POLL_INTERVAL)
+
+	async def _command(self, command: str) -> List[str]:
+		reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(self._socket), self._timeout)
+		try:
+			writer.write(('%s\n' % command).encode())
+			response = await asyncio.wait_for(reader.read(), self._timeout)
+		finally:
+			writer.close()
+
+		return response.decode().splitlines()
+
+	@staticmethod
+	def _parse_proc(response: List[str]) -> List[Process]:
+		"""
+		Parses output of `show proc`; old workers are listed in a separate section (or as [was: N] in older versions)
+		"""
+		processes = []
+		old = False
+		for line in response:
+			if line.startswith('#'):
+				if line.startswith('# '):
+					old = line[2:].strip() == 'old workers'
+				continue
+
+			columns = line.split()
+			if len(columns) < 3:
+				continue
+
+			processes.append(Process(int(columns[0]), columns[1], old or columns[2].startswith('[was:')))
+
+		return processes
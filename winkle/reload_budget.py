@@ -0,0 +1,44 @@
+import time
+from collections import deque
+from typing import Callable, Deque
+
+class ReloadBudget:
+	"""
+	Limits number of reloads within a sliding time window
+	"""
+
+	def __init__(self, reloads: int, window: float, timer: Callable[[], float] = time.monotonic):
+		"""
+		:param reloads: number of reloads allowed within the window (0 means unlimited)
+		:param window: length of the window, in seconds
+		:param timer: clock used to measure the window
+		"""
+		self._reloads = reloads
+		self._window = window
+		self._timer = timer
+
+		self._history = deque()  # type: Deque[float]
+
+	def delay(self) -> float:
+		"""
+		Returns how long the next reload needs to wait to fit into the budget
+		:return: seconds to wait, 0 when the reload can be done right away
+		"""
+		if self._reloads <= 0:
+			return 0.0
+
+		now = self._timer()
+		while self._history and self._history[0] <= now - self._window:
+			self._history.popleft()
+
+		if len(self._history) < self._reloads:
+			return 0.0
+
+		return self._history[0] + self._window - now
+
+	def spend(self) -> None:
+		"""
+		Records a reload
+		"""
+		if self._reloads > 0:
+			self._history.append(self._timer())
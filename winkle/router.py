@@ -1,8 +1,10 @@
 import asyncio
 import functools
+import inspect
 import logging
 import signal
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
 from typing import Any, Mapping, Optional, Tuple, Callable, List, Dict
 
@@ -18,6 +20,8 @@ class Router:
 		self._config = config
 
 		self._loop = None            # type: Optional[asyncio.BaseEventLoop]
+		self._loop_thread = None     # type: Optional[int]
+		self._executor = None        # type: Optional[ThreadPoolExecutor]
 		self.__control_lock = threading.Lock()
 
 		# noinspection PyProtectedMember
@@ -31,11 +35,14 @@ class Router:
 			'services_needed': self.sinks.services_needed,  # obtain service list for given source
 			'change_detected': self.sinks.change_detected,  # notify sink about a change
 			'service2sources': self.service2sources,        # convert canonical service name to (source, services) tuple
-			'source2service': self.source2service           # convert source, service pair into canonical service name
+			'source2service': self.source2service,          # convert source, service pair into canonical service name
+			'discovery_options': self.discovery_options     # obtain discovery section of a service (source, service)
 		}
 		sink_hooks = {
 			'service_nodes': self.sources.service_nodes,    # obtain list of healthy nodes for canonical service
+			'snapshot': self.sources.snapshot,              # obtain latest published state of sources
 			'run_main_thread': self.run_main_thread,        # schedule task execution in the main thread
+			'run_blocking': self.run_blocking,              # run blocking task without stalling the main loop
 			'service2sources': self.service2sources         # convert canonical service name to (source, services) tuple
 		}
 		self.sources.set_hooks(src_hooks)
@@ -53,14 +60,24 @@ class Router:
 			self._source2service[(method, service)] = service_name
 
 	def run(self) -> None:
+		single_loop = self._config['program']['single-loop']
+
 		self.sinks.start()
-		self.sources.start()
 
 		with closing(asyncio.new_event_loop()) as loop:
 			asyncio.set_event_loop(loop)
 
 			with self.__control_lock:
 				self._loop = loop
+				self._loop_thread = threading.get_ident()
+
+			if single_loop:
+				# sources run in this loop, blocking work of sinks is done in a worker thread
+				log.info("Running in single loop mode")
+				self._executor = ThreadPoolExecutor(max_workers=1)
+				self.sources.start(loop)
+			else:
+				self.sources.start()
 
 			# noinspection PyShadowingNames
 			def signal_handler(signame):
@@ -72,12 +89,16 @@ class Router:
 
 			loop.run_forever()
 
+		if self._executor:
+			self._executor.shutdown(wait=False)
+
 		self.sources.stop()
 		self.sinks.stop()
 
 	def run_main_thread(self, task: Callable[[], Any], *args: List[Any], **kwargs: Dict[str, Any]):
 		"""
-		Run function in the main thread and returns Future.
+		Run function in the main thread and returns Future. If the function returns an awaitable, it is awaited.
+		When called from the main thread (single loop mode) the task is scheduled directly in the loop.
 		:param task: function to call
 		:param args: arguments to the function
 		:param kwargs: keyword arguments to the function
@@ -87,14 +108,44 @@ class Router:
 
 		async def coroutine():
 			try:
-				return task(*args, **kwargs)
+				result = task(*args, **kwargs)
+				if inspect.isawaitable(result):
+					result = await result
+
+				return result
 			except Exception:
 				log.exception("Got exception when executing a subroutine")
 				raise
 
+		if threading.get_ident() == self._loop_thread:
+			return asyncio.ensure_future(coroutine(), loop=self._loop)
+
 		with self.__control_lock:
 			return asyncio.run_coroutine_threadsafe(coroutine(), self._loop)
 
+	def run_blocking(self, task: Callable[[], Any], *args: List[Any], **kwargs: Dict[str, Any]) -> asyncio.Future:
+		"""
+		Run blocking function from the main thread. In single loop mode the function is executed in a worker thread,
+		so it doesn't stall sources, otherwise the main thread is dedicated to sinks and it is called directly.
+		Tasks are executed one at a time.
+		:param task: function to call
+		:param args: arguments to the function
+		:param kwargs: keyword arguments to the function
+		:return: future containing the result
+		"""
+		assert self._loop is not None
+
+		if self._executor:
+			return self._loop.run_in_executor(self._executor, functools.partial(task, *args, **kwargs))
+
+		future = self._loop.create_future()
+		try:
+			future.set_result(task(*args, **kwargs))
+		except Exception as e:
+			future.set_exception(e)
+
+		return future
+
 	def service2sources(self, canonical_service: str, data_centers: Optional[str]) -> Tuple[str, List[str]]:
 		"""
 		Convert canonical service name to (source, service) tuple.
@@ -118,3 +169,11 @@ class Router:
 			service = dc_service[1]
 
 		return self._source2service[(source, service)]
+
+	def discovery_options(self, source: str, service: str) -> Mapping[str, Any]:
+		"""
+		Returns discovery options of a service from the services config
+		:param source: name of the source
+		:param service: name of the service as known to the source (possibly with data center)
+		"""
+		return self._services_config[self.source2service(source, service)]['discovery']
@@ -1,11 +1,18 @@
+import asyncio
 import hashlib
 import logging
-import subprocess
+import re
+import shlex
 from pathlib import Path
-from typing import Any, Mapping
+from typing import Any, List, Mapping, Optional, Tuple
 
 log = logging.getLogger(__name__)
 
+# commands containing any of these characters need to be executed by a shell
+SHELL_SYNTAX = re.compile(r'[$`|&;<>]')
+
+PROC = Path('/proc')
+
 class UpdateError(Exception):
 	pass
 
@@ -22,6 +29,19 @@ class ServiceUpdater:
 		self._status = config['status']          # type: str
 		self._start = config['start']            # type: str
 		self._reload = config['reload']          # type: str
+		self._timeout = config.get('command-timeout', 60)  # type: float
+
+		for command in (self._checkcfg, self._status, self._start, self._reload):
+			if SHELL_SYNTAX.search(command):
+				log.warning("'%s' needs to be executed by a shell; consider using {pid} instead of $(cat {pidfile})",
+					command)
+
+		# hash of the staged (validated, but not installed yet) config
+		self._staged_hash = None  # type: Optional[str]
+
+		# hash of the installed config file and signature (inode, size, mtime) of the file it was computed from
+		self._file_hash = None       # type: Optional[str]
+		self._file_signature = None  # type: Optional[Tuple[int, int, int]]
 
 	def needs_update(self, new_config: bytes) -> bool:
 		new_hash = self._compute_hash(new_config)
@@ -29,19 +49,35 @@ class ServiceUpdater:
 
 		return new_hash != old_hash
 
-	def update_config(self, new_config: bytes) -> None:
+	async def update_config(self, new_config: bytes) -> None:
 		"""Update configuration
 		:param new_config new configuration
 		:raises UpdateError
 		"""
+		await self.stage_config(new_config)
+		self.install_config()
+
+	async def stage_config(self, new_config: bytes) -> None:
+		"""Writes new configuration next to the current one and validates it
+		:param new_config new configuration
+		:raises UpdateError
+		"""
+		self._staged_hash = None
+
 		log.info("Writing new configuration to %s", self._config_file_new)
 		with self._config_file_new.open('wb') as of:
 			of.write(new_config)
 
 		log.info("Validating %s", self._config_file_new)
-		if not self.validate_config(str(self._config_file_new)):
+		if not await self.validate_config(str(self._config_file_new)):
 			raise UpdateError("Generated config is not valid.")
 
+		self._staged_hash = self._compute_hash(new_config)
+
+	def install_config(self) -> None:
+		"""Replaces current configuration with the staged one"""
+		assert self._staged_hash is not None, 'stage_config() was not called'
+
 		if self._config_file.is_file():
 			log.debug("Creating backup file: %s", self._config_file_backup)
 			self._config_file.rename(self._config_file_backup)
@@ -49,31 +85,133 @@ class ServiceUpdater:
 		log.info("Installing new config in %s" % self._config_file)
 		self._config_file_new.rename(self._config_file)
 
-	def validate_config(self, file: str) -> bool:
+		self._remember_file(self._staged_hash)
+		self._staged_hash = None
+
+	async def validate_config(self, file: str) -> bool:
 		log.debug("Validating config %s", file)
-		return subprocess.call(self._checkcfg.format(config=file), shell=True) == 0
+		return await self._execute(self._checkcfg, config=file)
+
+	async def is_running(self) -> bool:
+		"""
+		Checks whether haproxy is running; processes listed in the pid file are looked up in /proc, the status command
+		is only executed when that's not possible
+		"""
+		pids = self._read_pids()
+		if pids and PROC.is_dir():
+			return any((PROC / str(pid)).is_dir() for pid in pids)
+
+		return await self._execute(self._status)
+
+	async def start(self) -> bool:
+		return await self._execute(self._start)
 
-	def is_running(self) -> bool:
-		return subprocess.call(self._status.format(pidfile=self._pidfile), shell=True) == 0
+	async def reload(self) -> bool:
+		return await self._execute(self._reload)
 
-	def start(self) -> bool:
-		return subprocess.call(self._start.format(config=self._config_file, pidfile=self._pidfile), shell=True) == 0
+	def _read_pids(self) -> List[int]:
+		try:
+			with open(self._pidfile) as f:
+				return [int(line) for line in f.read().split()]
+		except (OSError, ValueError):
+			return []
 
-	def reload(self) -> bool:
-		return subprocess.call(self._reload.format(config=self._config_file, pidfile=self._pidfile), shell=True) == 0
+	def _placeholders(self, pids: List[str], **kwargs: str) -> Mapping[str, str]:
+		return dict({'config': str(self._config_file), 'pidfile': self._pidfile, 'pid': ' '.join(pids)}, **kwargs)
+
+	def _command_args(self, command: str, **kwargs: str) -> List[str]:
+		"""
+		Splits command into arguments and fills in placeholders ({config}, {pidfile} and {pid})
+		"""
+		pids = [str(pid) for pid in self._read_pids()]
+		values = self._placeholders(pids, **kwargs)
+
+		args = []
+		for arg in shlex.split(command):
+			# same as $(cat {pidfile}); every pid is a separate argument
+			if arg == '{pid}':
+				args += pids
+			else:
+				args.append(arg.format(**values))
+
+		return args
+
+	async def _execute(self, command: str, **kwargs: str) -> bool:
+		"""
+		Executes command without blocking the loop
+		:param command: command with placeholders
+		:param kwargs: values of additional placeholders
+		:return: whether the command succeeded (also false when it timed out)
+		"""
+		if SHELL_SYNTAX.search(command):
+			values = self._placeholders([str(pid) for pid in self._read_pids()], **kwargs)
+			process = await asyncio.create_subprocess_shell(command.format(**values))
+		else:
+			process = await asyncio.create_subprocess_exec(*self._command_args(command, **kwargs))
+
+		try:
+			return await asyncio.wait_for(process.wait(), self._timeout) == 0
+		except asyncio.TimeoutError:
+			log.error("'%s' didn't finish in %s seconds; killing it", command, self._timeout)
+			reaped = self._kill(process)
+			if reaped is not None:
+				await reaped
+			return False
+		except asyncio.CancelledError:
+			# result is no longer needed (e.g. validation of a config which won't be installed)
+			log.debug("'%s' was cancelled; killing it", command)
+			self._kill(process)
+			raise
+
+	@staticmethod
+	def _kill(process: asyncio.subprocess.Process) -> Optional[asyncio.Future]:
+		"""
+		Kills the process, it is reaped in background
+		:return: future of reaping the process; None when it couldn't be killed (e.g. it runs under sudo), then it is
+		         reaped once it finishes on its own
+		"""
+		reaped = asyncio.ensure_future(process.wait())
+		try:
+			process.kill()
+		except ProcessLookupError:
+			pass
+		except OSError as e:
+			log.warning("Failed to kill process %d (%s); leaving it to finish", process.pid, e)
+			return None
+
+		return reaped
 
 	def _get_file_hash(self) -> str:
 		"""
-		Computes hash of the configuration file
+		Computes hash of the configuration file; the file is only read when it changed since the hash was computed
 		:return: computed hash or empty string when file does not exist
 		"""
 
-		if not self._config_file.is_file():
+		signature = self._get_file_signature()
+		if signature is None:
 			return ''
 
+		if signature == self._file_signature:
+			return self._file_hash
+
+		log.debug("%s changed on disk; computing its hash", self._config_file)
 		with self._config_file.open('rb') as f:
-			return self._compute_hash(f.read())
+			return self._remember_file(self._compute_hash(f.read()))
+
+	def _get_file_signature(self) -> Optional[Tuple[int, int, int]]:
+		try:
+			st = self._config_file.stat()
+		except FileNotFoundError:
+			return None
+
+		return st.st_ino, st.st_size, st.st_mtime_ns
+
+	def _remember_file(self, file_hash: str) -> str:
+		self._file_hash = file_hash
+		self._file_signature = self._get_file_signature()
+
+		return file_hash
 
 	@staticmethod
 	def _compute_hash(data: bytes) -> str:
-		return hashlib.md5(data).hexdigest()
\ No newline at end of file
+		return hashlib.blake2b(data, digest_size=16).hexdigest()
\ No newline at end of file
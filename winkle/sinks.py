@@ -1,6 +1,7 @@
 import logging
 from typing import Any, Callable, List, Optional, Mapping
 
+from .coalescer import Coalescer
 from .haproxy import HAProxy
 from .types import T_CHANGES
 
@@ -10,6 +11,7 @@ class Sinks:
 	def __init__(self, config: Mapping[str, Any], services: Mapping[str, Any]):
 		self._hooks = None  # type: Optional[Mapping[str, Callable]]
 		self.haproxy = HAProxy(config, services)
+		self._coalescer = Coalescer(self._process_update, self.haproxy.update_delays)
 
 	def set_hooks(self, hooks: Mapping[str, Callable]) -> None:
 		self._hooks = hooks
@@ -31,8 +33,12 @@ class Sinks:
 		return services.get(source, [])
 
 	def change_detected(self, source: str, changes: T_CHANGES) -> None:
+		# changes are held in the main thread for a while, so bursts result in a single update
+		self._hooks['run_main_thread'](self._coalescer.submit, source, changes)
+
+	def _process_update(self, source: str, changes: T_CHANGES) -> None:
 		def process_change():
 			log.debug("Got update from %s", source)
-			self.haproxy.process_update(source, changes)
+			return self.haproxy.process_update(source, changes)
 
 		self._hooks['run_main_thread'](process_change)
@@ -1,7 +1,8 @@
-from typing import Any, Callable, List, Mapping, Optional
+import asyncio
+from typing import Any, Callable, Dict, List, Mapping, Optional
 
 from .consul_listener import ConsulListener
-from .types import Node
+from .types import Node, Snapshot
 
 class Sources:
 	def __init__(self, config: Mapping[str, Any]):
@@ -12,15 +13,23 @@ class Sources:
 		self._hooks = hooks
 		self.consul.set_hooks(hooks)
 
-	def start(self):
-		self.consul.start()
+	def start(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+		self.consul.start(loop)
 
 	def stop(self):
 		pass
 
-	def service_nodes(self, service_name: str, data_centers: Optional[str]) -> List[Node]:
+	def snapshot(self) -> Dict[str, Snapshot]:
+		"""
+		Returns latest published snapshot of every source
+		"""
+		return {'consul': self.consul.snapshot}
+
+	def service_nodes(self, service_name: str, data_centers: Optional[str],
+			snapshots: Optional[Mapping[str, Snapshot]] = None) -> List[Node]:
 		source, services = self._hooks['service2sources'](service_name, data_centers)
+		snapshot = snapshots[source] if snapshots else None
 		if source == 'consul':
-			return [ n for service in services for n in self.consul.service_nodes(service) ]
+			return [ n for service in services for n in self.consul.service_nodes(service, snapshot) ]
 
 		raise NotImplemented()
@@ -1,55 +1,101 @@
-from typing import Dict, FrozenSet, NamedTuple, Any
+import sys
+from typing import Any, Dict, FrozenSet, Hashable, Iterable, Mapping, NamedTuple, Tuple, TypeVar
+
+T = TypeVar('T', bound=Hashable)
 
 class hashabledict(dict):
+	"""
+	Immutable dictionary which computes its hash only once
+	"""
+	__slots__ = ('_hash',)
+
+	def __init__(self, *args, **kwargs) -> None:
+		super().__init__(*args, **kwargs)
+		self._hash = None
+
 	def __hash__(self) -> int:
-		return hash(tuple(sorted(self.items())))
+		if self._hash is None:
+			self._hash = hash(frozenset(self.items()))
+
+		return self._hash
 
 	def __eq__(self, other: Dict) -> bool:
+		if self is other:
+			return True
+
 		if not isinstance(other, self.__class__):
 			return False
 
-		return tuple(sorted(self.items())) == tuple(sorted(other.items()))
+		return hash(self) == hash(other) and dict.__eq__(self, other)
 
-Node = NamedTuple('Node', (
-	('address', str),
-	('port', str),
-	('name', str),
-	('attrs', hashabledict),
-	('tags', FrozenSet[str])))
+	def __ne__(self, other: Dict) -> bool:
+		return not self == other
 
-Changes = NamedTuple('Changes', (
-	('added', FrozenSet[Node]),
-	('removed', FrozenSet[Node]),
-	('updated', FrozenSet[Node])))
+	def __reduce__(self):
+		return self.__class__, (dict(self),)
 
-T_CHANGES = Dict[str, Changes]
+	def _immutable(self, *args, **kwargs):
+		raise TypeError("%s is immutable" % self.__class__.__name__)
 
-class NodeAddr:
+	__setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+class InternPool:
 	"""
-	Wrapper for `Node` which makes it comparable only by address/port
+	Shares identical immutable values, so they are stored only once. The pool is bounded, when it gets full it
+	starts over (already shared values stay shared).
 	"""
 
-	def __init__(self, node: Node):
-		self.node = node
+	def __init__(self, maxsize: int = 65536):
+		self._maxsize = maxsize
+		self._pool = {}  # type: Dict[Any, Any]
 
-	def __hash__(self):
-		return hash(self.node[0:2])
+	def __call__(self, value: T) -> T:
+		try:
+			return self._pool[value]
+		except KeyError:
+			pass
 
-	def __eq__(self, other: Any):
-		if not isinstance(other, self.__class__):
-			return False
+		if len(self._pool) >= self._maxsize:
+			self._pool.clear()
+
+		self._pool[value] = value
+		return value
+
+	def __len__(self) -> int:
+		return len(self._pool)
+
+intern_attrs = InternPool()
+intern_tags = InternPool()
 
-		return self.node[0:2] == other.node[0:2]
+class Node(NamedTuple('Node', (
+		('address', str),
+		('port', str),
+		('name', str),
+		('attrs', hashabledict),
+		('tags', FrozenSet[str])))):
+	__slots__ = ()
 
-	def __getattribute__(self, item):
-		if item == 'node':
-			return object.__getattribute__(self, item)
+	@classmethod
+	def create(cls, address: str, port: str, name: str, attrs: Mapping[str, str], tags: Iterable[str]) -> 'Node':
+		"""
+		Creates a node sharing its attributes and tags with identical nodes
+		"""
+		if not isinstance(attrs, hashabledict):
+			attrs = hashabledict(attrs)
 
-		return self.node.__getattribute__(item)
+		if not isinstance(tags, frozenset):
+			tags = frozenset(tags)
 
-	def __getitem__(self, item):
-		return self.node.__getitem__(item)
+		return cls(sys.intern(address), port, sys.intern(name), intern_attrs(attrs), intern_tags(tags))
 
-	def __repr__(self):
-		return self.node.__repr__()
+Changes = NamedTuple('Changes', (
+	('added', FrozenSet[Node]),
+	('removed', FrozenSet[Node]),
+	('updated', FrozenSet[Node])))
+
+T_CHANGES = Dict[str, Changes]
 
+# Immutable state of a source; a new one (with higher version) is published on every change
+Snapshot = NamedTuple('Snapshot', (
+	('version', int),
+	('services', Mapping[str, Tuple[Node, ...]])))